@@ -0,0 +1,94 @@
+import os
+
+from ..krita_sync.cks_common.CksBinaryMessage import ImageFormat, DEFAULT_CHUNK_SIZE
+
+
+# Server-side settings, read once from the environment when ComfyUI loads the node pack
+
+
+def _get_int(name, default, minimum=None):
+    try:
+        value = int(os.environ.get(name, default))
+    except ValueError:
+        print(f"Ignoring invalid {name}, expected an integer")
+        return default
+    if minimum is not None and value < minimum:
+        print(f"Ignoring invalid {name}={value}, expected at least {minimum}")
+        return default
+    return value
+
+
+def _get_float(name, default, minimum=None):
+    try:
+        value = float(os.environ.get(name, default))
+    except ValueError:
+        print(f"Ignoring invalid {name}, expected a number")
+        return default
+    if minimum is not None and value < minimum:
+        print(f"Ignoring invalid {name}={value}, expected at least {minimum}")
+        return default
+    return value
+
+
+def _get_bool(name, default):
+    value = os.environ.get(name, str(default)).strip().lower()
+    if value in ("1", "true", "yes", "on"):
+        return True
+    if value in ("0", "false", "no", "off"):
+        return False
+    print(f"Ignoring invalid {name}={value}, expected true or false")
+    return default
+
+
+def _get_str(name, default, choices=None):
+    value = os.environ.get(name, default).strip().lower()
+    if choices is not None and value not in choices:
+        print(f"Ignoring invalid {name}={value}, expected one of {', '.join(choices)}")
+        return default
+    return value
+
+
+# How images are sent to Krita: auto picks raw pixels for local clients and PNG for remote ones
+IMAGE_FORMAT = ImageFormat(_get_str("CKS_IMAGE_FORMAT", ImageFormat.AUTO.value, [image_format.value for image_format in ImageFormat]))
+
+# Largest websocket message used when streaming to clients that support chunking
+CHUNK_SIZE = _get_int("CKS_CHUNK_SIZE", DEFAULT_CHUNK_SIZE, minimum=4096)
+
+# Default number of seconds GetImageKrita waits for Krita to answer
+GET_IMAGE_TIMEOUT = _get_float("CKS_GET_IMAGE_TIMEOUT", 10.0, minimum=0.1)
+
+# Worker threads for decoding images from Krita and writing previews, off the shared event loop
+PROCESSING_WORKERS = _get_int("CKS_PROCESSING_WORKERS", 2, minimum=1)
+
+# Websocket messages larger than this many bytes are unpacked on a worker thread instead of the event loop
+INLINE_DECODE_LIMIT = _get_int("CKS_INLINE_DECODE_LIMIT", 256 * 1024, minimum=0)
+
+# Worker threads encoding images sent to Krita, so a batch is encoded in parallel instead of one after another
+ENCODE_WORKERS = _get_int("CKS_ENCODE_WORKERS", min(4, os.cpu_count() or 1), minimum=1)
+
+# Messages waiting per client before CKS_QUEUE_FULL_POLICY applies
+SEND_QUEUE_DEPTH = _get_int("CKS_SEND_QUEUE_DEPTH", 16, minimum=1)
+
+# What to do when a client's queue is full: disconnect it, or drop the new message
+QUEUE_FULL_POLICY = _get_str("CKS_QUEUE_FULL_POLICY", "disconnect", ["disconnect", "drop"])
+
+# Memory budget for Krita layers cached between prompts, in megabytes (0 disables the cache)
+IMAGE_CACHE_MB = _get_int("CKS_IMAGE_CACHE_MB", 512, minimum=0)
+
+# Seconds a cached layer is used without asking Krita whether it changed, covers several nodes reading it in one prompt
+IMAGE_CACHE_MAX_AGE = _get_float("CKS_IMAGE_CACHE_MAX_AGE", 1.0, minimum=0.0)
+
+# Minimum seconds between updates Krita pushes for layers read by GetImageKrita nodes with live enabled
+LIVE_UPDATE_INTERVAL = _get_float("CKS_LIVE_UPDATE_INTERVAL", 0.5, minimum=0.1)
+
+# Seconds a live layer stays subscribed after a node last read it
+SUBSCRIPTION_TTL = _get_float("CKS_SUBSCRIPTION_TTL", 600.0, minimum=10.0)
+
+# Seconds a layer fetched ahead of time when a prompt is queued is kept if no node reads it (0 disables prefetching)
+PREFETCH_TTL = _get_float("CKS_PREFETCH_TTL", 300.0, minimum=0.0)
+
+# Seconds document changes are collected before browsers are told to refresh the document combos
+DOCUMENT_REFRESH_DELAY = _get_float("CKS_DOCUMENT_REFRESH_DELAY", 0.25, minimum=0.0)
+
+# Put images from Krita in pinned memory, which speeds up their copy to the GPU at the cost of page-locked RAM
+PIN_MEMORY = _get_bool("CKS_PIN_MEMORY", False)
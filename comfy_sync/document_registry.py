@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+
+@dataclass
+class KritaDocument:
+    document_id: str
+    name: str
+    sid: str  # Client the document is open in
+    depth: str = "U8"  # Krita color depth, U8, U16, F16 or F32
+
+    @property
+    def display_name(self) -> str:
+        return f"{self.name} ({self.document_id.split('-')[0]})"
+
+
+class DocumentRegistry:
+    """
+    Documents open in every connected Krita client, indexed by document id and by the display name shown in the
+    document combo. Updates return whether the set of display names changed, which is all the combo and the browser
+    care about.
+
+    Only used from the event loop.
+    """
+    def __init__(self):
+        self.by_id: dict[str, KritaDocument] = {}
+        self.by_name: dict[str, KritaDocument] = {}
+
+    def __contains__(self, display_name) -> bool:
+        return display_name in self.by_name
+
+    def __getitem__(self, display_name) -> KritaDocument:
+        return self.by_name[display_name]
+
+    def get(self, display_name) -> KritaDocument | None:
+        return self.by_name.get(display_name)
+
+    def names(self) -> list[str]:
+        return list(self.by_name.keys())
+
+    def replace(self, sid, document_list) -> bool:
+        """
+        Sets the full list of documents open in one client.
+        """
+        document_ids = {item[0] for item in document_list}
+        removed = [document.document_id for document in self.by_id.values() if document.sid == sid and document.document_id not in document_ids]
+        return self.update(sid, document_list, removed)
+
+    def update(self, sid, document_list, removed) -> bool:
+        """
+        Applies documents a client opened, renamed or closed. Items are (id, name) or (id, name, depth), older Krita
+        plugins don't send the depth.
+        """
+        names = set(self.by_name)
+        for document_id in removed:
+            document = self.by_id.get(document_id)
+            if document is not None and document.sid == sid:
+                self._remove(document)
+        for item in document_list:
+            document = KritaDocument(item[0], item[1], sid, item[2] if len(item) > 2 else "U8")
+            previous = self.by_id.get(document.document_id)
+            if previous == document:
+                continue
+            if previous is not None:
+                self._remove(previous)
+            self._add(document)
+        return names != set(self.by_name)
+
+    def remove_client(self, sid) -> bool:
+        names = set(self.by_name)
+        for document in [document for document in self.by_id.values() if document.sid == sid]:
+            self._remove(document)
+        return names != set(self.by_name)
+
+    def _add(self, document: KritaDocument):
+        self.by_id[document.document_id] = document
+        self.by_name[document.display_name] = document
+
+    def _remove(self, document: KritaDocument):
+        self.by_id.pop(document.document_id, None)
+        if self.by_name.get(document.display_name) is document:
+            del self.by_name[document.display_name]
@@ -0,0 +1,188 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import time
+from dataclasses import dataclass, field
+
+
+def response_nbytes(response) -> int:
+    """
+    Approximate memory held by a KritaImageResponse: the payload as received plus the decoded PNG and mask.
+    """
+    nbytes = 0
+    if response.image is not None:
+        nbytes += response.image.width * response.image.height * len(response.image.getbands())
+    if response.payload is not None:
+        (_, content) = response.payload
+        nbytes += memoryview(getattr(content, "data", content)).nbytes
+    if response.mask is not None:
+        nbytes += response.mask.nbytes
+    return nbytes
+
+
+@dataclass
+class LayerCacheEntry:
+    revision: str
+    response: object  # KritaImageResponse
+    nbytes: int
+    validated_at: float = field(default_factory=time.monotonic)
+    read: bool = False  # Whether a node used it, prefetched entries nobody read expire
+
+
+class LayerImageCache:
+    """
+    Most recently used Krita layers, keyed by (document id, layer) and tagged with the content revision Krita
+    reported for them. A cached layer is revalidated by sending Krita its revision, which costs a round trip but no
+    pixels when nothing changed, and only the changed tiles when something did. Concurrent fetches of the same key
+    share one request to Krita.
+
+    Only used from the event loop.
+    """
+    def __init__(self, max_bytes: int, max_age: float, prefetch_ttl: float, apply_delta):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.prefetch_ttl = prefetch_ttl
+        # Coroutine function (base response, delta response) -> full response
+        self._apply_delta = apply_delta
+        # Subscribed keys Krita keeps current by pushing updates, trusted regardless of max_age
+        self.live = set()
+        self._entries: collections.OrderedDict[tuple, LayerCacheEntry] = collections.OrderedDict()
+        self._in_flight: dict[tuple, asyncio.Task] = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.revalidated = 0
+        self.patched = 0
+        self.pushed = 0
+        self.prefetch_expired = 0
+        self.misses = 0
+        self.shared = 0
+
+    def revision(self, key) -> str:
+        entry = self._entries.get(key)
+        return entry.revision if entry is not None else ""
+
+    async def get(self, key, fetch, prefetch=False):
+        """
+        Returns the layer for key, calling fetch(known_revision) to ask Krita when the cached copy isn't fresh.
+        fetch must return a KritaImageResponse. Prefetches warm the cache without counting as a read.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and (key in self.live or time.monotonic() - entry.validated_at < self.max_age):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            response = entry.response
+        else:
+            task = self._in_flight.get(key)
+            if task is None:
+                task = asyncio.get_running_loop().create_task(self._refresh(key, fetch))
+                self._in_flight[key] = task
+                task.add_done_callback(lambda _: self._in_flight.pop(key, None) if self._in_flight.get(key) is task else None)
+            else:
+                self.shared += 1
+            # One waiter giving up must not cancel the fetch for the others
+            response = await asyncio.shield(task)
+
+        entry = self._entries.get(key)
+        if entry is not None and entry.response is response:
+            if not prefetch:
+                entry.read = True
+            elif not entry.read:
+                asyncio.get_running_loop().call_later(self.prefetch_ttl, self._expire_prefetched, key, entry)
+        return response
+
+    def _expire_prefetched(self, key, entry: LayerCacheEntry):
+        if self._entries.get(key) is entry and not entry.read and key not in self.live:
+            self.discard(key)
+            self.prefetch_expired += 1
+
+    async def _refresh(self, key, fetch):
+        known_revision = self.revision(key)
+        response = await fetch(known_revision)
+        json_payload = response.json_payload
+
+        if json_payload.unchanged or json_payload.base_revision:
+            entry = self._entries.get(key)
+            base_revision = json_payload.revision if json_payload.unchanged else json_payload.base_revision
+            if entry is None or entry.revision != base_revision:
+                # Evicted while the request was out, ask again for the whole layer
+                response = await fetch("")
+                json_payload = response.json_payload
+            elif json_payload.unchanged:
+                entry.validated_at = time.monotonic()
+                self._entries.move_to_end(key)
+                self.revalidated += 1
+                return entry.response
+            else:
+                response = await self._apply_delta(entry.response, response)
+                self.patched += 1
+                self.discard(key)
+                self._store(key, LayerCacheEntry(json_payload.revision, response, response_nbytes(response)))
+                return response
+
+        self.misses += 1
+        self.discard(key)
+        if response.found and json_payload.revision:
+            self._store(key, LayerCacheEntry(json_payload.revision, response, response_nbytes(response)))
+        return response
+
+    async def update(self, key, response):
+        """
+        Applies an update Krita pushed for a subscribed layer, which makes the key live until an update can't be
+        applied.
+        """
+        json_payload = response.json_payload
+        entry = self._entries.get(key)
+        if json_payload.unchanged or json_payload.base_revision:
+            base_revision = json_payload.revision if json_payload.unchanged else json_payload.base_revision
+            if entry is None or entry.revision != base_revision:
+                # Missing the base, go back to fetching until an update lines up with what is cached again
+                self.live.discard(key)
+                self.discard(key)
+                return
+            if json_payload.unchanged:
+                entry.validated_at = time.monotonic()
+            else:
+                response = await self._apply_delta(entry.response, response)
+                self.discard(key)
+                self._store(key, LayerCacheEntry(json_payload.revision, response, response_nbytes(response)))
+        elif response.found:
+            self.discard(key)
+            self._store(key, LayerCacheEntry(json_payload.revision, response, response_nbytes(response)))
+        else:
+            # Layer is gone
+            self.live.discard(key)
+            self.discard(key)
+            return
+        self.pushed += 1
+        self.live.add(key)
+
+    def _store(self, key, entry: LayerCacheEntry):
+        if entry.nbytes > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.max_bytes:
+            (_, evicted) = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry.nbytes
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "patched": self.patched,
+            "pushed": self.pushed,
+            "live": len(self.live),
+            "prefetch_expired": self.prefetch_expired,
+            "misses": self.misses,
+            "shared": self.shared,
+            "in_flight": len(self._in_flight)
+        }
@@ -0,0 +1,30 @@
+import numpy as np
+import torch
+
+# Values converted per step on the CPU, few enough that the float scratch buffer stays in cache
+_CONVERT_STEP = 1 << 18
+
+
+def images_to_uint8(images: torch.Tensor) -> np.ndarray:
+    """
+    Converts a whole IMAGE batch to one B x H x W x C uint8 buffer. Indexing the result gives per-image views into
+    that buffer.
+
+    Batches on the GPU are scaled, clamped and cast there, so only the uint8 result crosses to the host, in a single
+    transfer. On the CPU, numpy does the work a slice at a time through one scratch buffer: it casts to uint8 several
+    times faster than torch, and a float copy of the whole batch would cost more in page faults than the math.
+    """
+    images = images.detach()
+    if images.device.type != "cpu":
+        return images.mul(255.0).clamp_(0, 255).to(torch.uint8).cpu().numpy()
+
+    source = images.to(torch.float32).reshape(-1).numpy()
+    result = np.empty(tuple(images.shape), dtype=np.uint8)
+    flat_result = result.reshape(-1)
+    scratch = np.empty(min(_CONVERT_STEP, source.size), dtype=np.float32)
+    for start in range(0, source.size, _CONVERT_STEP):
+        part = scratch[:min(_CONVERT_STEP, source.size - start)]
+        np.multiply(source[start:start + part.size], 255.0, out=part)
+        np.clip(part, 0, 255, out=part)
+        np.copyto(flat_result[start:start + part.size], part, casting="unsafe")
+    return result
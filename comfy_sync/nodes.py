@@ -1,5 +1,7 @@
-import time
+import asyncio
 import uuid
+import concurrent.futures
+import warnings
 import torch
 import os
 import json
@@ -9,11 +11,14 @@ import node_helpers  # type: ignore
 from PIL import Image, ImageFile, ImageSequence, ImageOps
 from PIL.PngImagePlugin import PngInfo
 from server import PromptServer, BinaryEventTypes  # type: ignore
-from . import ws_krita
+from . import ws_krita, config
 from comfy.cli_args import args  # type: ignore
+import comfy.model_management  # type: ignore
+from nodes import MAX_RESOLUTION  # type: ignore
 
 from .ws_krita import KritaWsManager
-from ..krita_sync.cks_common.CksBinaryMessage import GetImageKritaJsonPayload, SendImageKritaJsonPayload
+from .image_convert import images_to_uint8
+from ..krita_sync.cks_common.CksBinaryMessage import GetImageKritaJsonPayload, SendImageKritaJsonPayload, ImageRegion, MaskSource, PayloadType, RAW_PIXEL_LAYOUTS, COLOR_DEPTH_PAYLOAD_TYPES
 
 
 def update_node_return_types():
@@ -22,6 +27,95 @@ def update_node_return_types():
     SelectKritaDocument.update_return_types()
 
 
+def wait_for_krita(future: concurrent.futures.Future, timeout: float):
+    """
+    Blocks the executing prompt until Krita answers, cancelling the request if the prompt is interrupted.
+    """
+    while True:
+        done, _ = concurrent.futures.wait([future], timeout=0.1)
+        if done:
+            break
+        if comfy.model_management.processing_interrupted():
+            future.cancel()
+            comfy.model_management.throw_exception_if_processing_interrupted()
+    try:
+        return future.result()
+    except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+        raise TimeoutError(f"Krita did not respond within {timeout} seconds")
+    except (asyncio.CancelledError, concurrent.futures.CancelledError):
+        comfy.model_management.throw_exception_if_processing_interrupted()
+        raise
+
+
+def images_to_native(images: torch.Tensor, depth: str):
+    """
+    Converts a whole IMAGE batch to the raw layout of a 16-bit or float Krita document, B x H x W x 4, keeping the
+    precision uint8 would lose. Returns None and the payload type for 8-bit documents. Values are passed through as
+    is, there is no color management on either side.
+    """
+    payload_type = COLOR_DEPTH_PAYLOAD_TYPES.get(depth, PayloadType.RAW_ARGB32)
+    if payload_type == PayloadType.RAW_ARGB32:
+        return None, payload_type
+
+    images = images.detach()
+    if images.shape[-1] == 3:
+        images = torch.cat((images, torch.ones_like(images[..., :1])), dim=-1)
+    if payload_type == PayloadType.RAW_BGRA16:
+        # Krita's 16-bit integer RGBA is B, G, R, A in memory, torch has no uint16 so it goes through int32
+        scaled = images[..., [2, 1, 0, 3]].clamp(0, 1).mul_(65535.0).round_()
+        return scaled.to(torch.int32).to(torch.int16).cpu().numpy().view(np.uint16), payload_type
+    if payload_type == PayloadType.RAW_RGBA16F:
+        return images.to(torch.float16).cpu().numpy(), payload_type
+    return images.to(torch.float32).cpu().numpy(), payload_type
+
+
+def raw_payload_to_tensors(payload, pin_memory=False):
+    """
+    Turns a raw pixel payload into an IMAGE and its alpha MASK, reading straight from the received bytes. Each
+    channel is converted in place into the outputs and scaled there, so the only allocations are the two float outputs.
+    """
+    (payload_type, content) = payload
+    layout = RAW_PIXEL_LAYOUTS[payload_type]
+    channels = len(layout.channel_order)
+    # Source index of R, G, B and A
+    channel_order = tuple(layout.channel_order.index(channel) for channel in "RGBA"[:channels])
+    scale = {"B": 1.0 / 255.0, "H": 1.0 / 65535.0}.get(layout.channel_format, 1.0)
+
+    pin_memory = pin_memory and torch.cuda.is_available()
+    image = torch.empty((1, content.height, content.width, 3), dtype=torch.float32, pin_memory=pin_memory)
+    mask = torch.zeros((1, content.height, content.width), dtype=torch.float32, pin_memory=pin_memory)
+    if layout.channel_format == "H":
+        # torch only has uint16 from 2.3, numpy widens each channel straight into the outputs instead
+        pixels = ws_krita.raw_pixels(content, payload_type)
+        for target, source in enumerate(channel_order[:3]):
+            np.copyto(image.numpy()[0, :, :, target], pixels[:, :, source], casting="unsafe")
+        np.copyto(mask.numpy()[0], pixels[:, :, channel_order[3]], casting="unsafe")
+    else:
+        dtype = {"B": torch.uint8, "e": torch.float16, "f": torch.float32}[layout.channel_format]
+        with warnings.catch_warnings():
+            # The received bytes are read only, and are only ever read here
+            warnings.simplefilter("ignore", UserWarning)
+            rows = torch.frombuffer(content.data, dtype=torch.uint8, count=content.stride * content.height)
+        row_pixels = rows.view(content.height, content.stride)[:, :content.width * layout.bytes_per_pixel]
+        pixels = row_pixels.view(dtype).unflatten(1, (content.width, channels))
+        # copy_ converts into a strided channel as it goes, mul with out= would allocate a temporary per channel
+        for target, source in enumerate(channel_order[:3]):
+            image[0, :, :, target].copy_(pixels[:, :, source])
+        if channels == 4:
+            mask[0].copy_(pixels[:, :, channel_order[3]])
+
+    if scale != 1.0:
+        image.mul_(scale)
+    if channels == 4:
+        # Transparent is 1, as in LoadImage
+        mask.mul_(-scale).add_(1.0)
+    if layout.channel_format != "B":
+        # Float documents can hold values outside 0 to 1, IMAGE can't
+        image.clamp_(0.0, 1.0)
+        mask.clamp_(0.0, 1.0)
+    return image, mask
+
+
 class SendImageKrita:
     @classmethod
     def INPUT_TYPES(s):
@@ -31,6 +125,9 @@ class SendImageKrita:
             "images": ("IMAGE",),
             "add_to_previous_run": ("BOOLEAN", {"default": False})
         },
+            "optional": {
+                "preview": ("BOOLEAN", {"default": True})
+            },
             "hidden": {
                 "prompt": "PROMPT",
                 "extra_pnginfo": "EXTRA_PNGINFO"
@@ -47,18 +144,26 @@ class SendImageKrita:
     def update_return_types(cls):
         cls.RETURN_TYPES = (KritaWsManager.instance().document_combo,)
 
-    def send_image_krita(self, document, layer, images, add_to_previous_run, prompt=None, extra_pnginfo=None):
+    def send_image_krita(self, document, layer, images, add_to_previous_run, preview=True, prompt=None, extra_pnginfo=None):
         if document == "Missing Document":
             raise Exception("Missing Document")
 
+        manager = ws_krita.KritaWsManager.instance()
+
         filename_prefix = "CKS_temp_" + ''.join(uuid.uuid4().hex)
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, folder_paths.get_temp_directory(), images[0].shape[1], images[0].shape[0])
         results = []
         result_images = []
-        for tensor in images:
-            array = 255.0 * tensor.cpu().numpy()
-            image = Image.fromarray(np.clip(array, 0, 255).astype(np.uint8))
-            result_images.append(image)
+        png_futures = []
+        krita_document = manager.documents.get(document)
+        for pixels in images_to_uint8(images):
+            result_images.append(ws_krita.OutgoingImage(pixels))
+
+            if not preview:
+                continue
+
+            # Shares memory with pixels, no copy
+            image = Image.fromarray(pixels)
 
             metadata = None
             if not args.disable_metadata:
@@ -69,7 +174,8 @@ class SendImageKrita:
                     for x in extra_pnginfo:
                         metadata.add_text(x, json.dumps(extra_pnginfo[x]))
             file = f"{filename}_{counter:05}_.png"
-            image.save(os.path.join(full_output_folder, file), pnginfo=metadata, compress_level=1)
+            # The preview PNG is encoded once, in parallel, and the same bytes go to Krita clients that take PNG
+            png_futures.append(manager.encode_executor.submit(ws_krita.save_png, image, metadata, os.path.join(full_output_folder, file)))
 
             results.append({
                 "filename": file,
@@ -78,17 +184,20 @@ class SendImageKrita:
             })
             counter += 1
 
-        # Send to Krita client
-        manager = ws_krita.KritaWsManager.instance()
+        for result_image, png_future in zip(result_images, png_futures):
+            result_image.png = png_future.result()
 
-        if document in KritaWsManager.instance().documents:
+        # Send to Krita client
+        if krita_document is not None:
             json_payload = SendImageKritaJsonPayload(
-                krita_document=KritaWsManager.instance().documents[document][0],
+                krita_document=krita_document.document_id,
                 krita_layer=layer,
                 run_uuid=PromptServer.instance.last_prompt_id,
                 add_to_previous_run=add_to_previous_run
             )
-            manager.send_sync(json_payload, result_images, KritaWsManager.instance().documents[document][1])
+            depth = krita_document.depth
+            # Only converted if a client that takes high bit depth raw pixels receives it
+            manager.send_sync(json_payload, result_images, krita_document.sid, deep_images=lambda: images_to_native(images, depth))
         else:
             print("SendImageKrita skipped because no matching document id.")
 
@@ -107,7 +216,25 @@ class GetImageKrita:
             "document": (KritaWsManager.instance().document_combo,),
             "layer": ("STRING", {"default": "Background"}),
             "cks_uuid": ("STRING", {"default": ""})
-        }}
+        },
+            "optional": {
+                "timeout": ("FLOAT", {"default": config.GET_IMAGE_TIMEOUT, "min": 0.1, "max": 600.0, "step": 0.1}),
+                "preview": ("BOOLEAN", {"default": True}),
+                # Krita pushes changes as they happen, so the layer is already here when the node runs. Only for the
+                # whole document at full size
+                "live": ("BOOLEAN", {"default": False}),
+                "region": ([region.value for region in ImageRegion], {"default": ImageRegion.DOCUMENT.value}),
+                "x": ("INT", {"default": 0, "min": 0, "max": MAX_RESOLUTION, "step": 1}),
+                "y": ("INT", {"default": 0, "min": 0, "max": MAX_RESOLUTION, "step": 1}),
+                "width": ("INT", {"default": 512, "min": 1, "max": MAX_RESOLUTION, "step": 1}),
+                "height": ("INT", {"default": 512, "min": 1, "max": MAX_RESOLUTION, "step": 1}),
+                # Krita scales the region down so its longer side fits, 0 keeps it as is
+                "max_side": ("INT", {"default": 0, "min": 0, "max": MAX_RESOLUTION, "step": 8}),
+                # Where the mask comes from: the layer's alpha, the active selection, or the selection mask named by mask_layer
+                "mask": ([source.value for source in MaskSource], {"default": MaskSource.ALPHA.value}),
+                "mask_layer": ("STRING", {"default": ""})
+            },
+        }
 
     RETURN_TYPES = "IMAGE", "MASK", KritaWsManager.instance().document_combo
 
@@ -119,35 +246,107 @@ class GetImageKrita:
     FUNCTION = "get_image_krita"
     OUTPUT_NODE = False
     CATEGORY = "cks"
+    # The inputs layer_request reads, the others don't change what is fetched
+    REQUEST_INPUTS = ("document", "layer", "region", "x", "y", "width", "height", "max_side", "mask", "mask_layer")
+
+    @staticmethod
+    def layer_request(document_id, layer, filename_prefix=None, region=ImageRegion.DOCUMENT.value, x=0, y=0, width=512, height=512, max_side=0,
+                      mask=MaskSource.ALPHA.value, mask_layer="", **kwargs):
+        """
+        The request IS_CHANGED, execution and prefetching all send for the same inputs, so they share one cache entry.
+        """
+        if filename_prefix is None:
+            # Clients that predate request ids are matched to their request by the prefix alone
+            filename_prefix = "CKS_temp_" + uuid.uuid4().hex
+        return GetImageKritaJsonPayload(krita_document=document_id, krita_layer=layer, filename_prefix=filename_prefix,
+                                        region=region, rect=[x, y, width, height], max_side=max_side, mask=mask, mask_layer=mask_layer)
 
-    def get_image_krita(self, document, layer, cks_uuid):
+    @classmethod
+    def IS_CHANGED(cls, document=None, layer=None, timeout=None, live=False, **kwargs):
+        """
+        Fetches the layer ahead of execution (the result stays cached for get_image_krita) and reports Krita's content
+        revision, so ComfyUI can reuse downstream results while the layer is unchanged.
+        """
+        manager = KritaWsManager.instance()
+        if document not in manager.documents or layer is None:
+            return float("NaN")
+        if timeout is None:
+            timeout = config.GET_IMAGE_TIMEOUT
+
+        (document_id, sid) = (manager.documents[document].document_id, manager.documents[document].sid)
+        json_payload = cls.layer_request(document_id, layer, **kwargs)
+        if live and len(json_payload.view_key()) == 2:
+            manager.subscribe_sync(document_id, layer, sid)
+        try:
+            response = wait_for_krita(manager.get_layer_image_sync(json_payload, sid, timeout), timeout)
+        except (TimeoutError, ConnectionError):
+            # Krita didn't answer or isn't connected, let execution run and report it. Interrupts and anything else
+            # still propagate
+            return float("NaN")
+        if not response.found or not response.json_payload.revision:
+            return float("NaN")
+        return response.json_payload.revision
+
+    def get_image_krita(self, document, layer, cks_uuid, timeout=None, preview=True, live=False, **kwargs):
         if document == "Missing Document":
             raise Exception("Missing Document")
 
+        if timeout is None:
+            timeout = config.GET_IMAGE_TIMEOUT
+
         results = []
 
         filename_prefix = "CKS_temp_" + ''.join(cks_uuid)
-        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, folder_paths.get_temp_directory())
-        file = f"{filename}_.png"
 
-        if document in KritaWsManager.instance().documents:
-            json_payload = GetImageKritaJsonPayload(krita_document=KritaWsManager.instance().documents[document][0], krita_layer=layer, filename_prefix=filename_prefix)
+        if document not in KritaWsManager.instance().documents:
+            raise Exception(f"GetImageKrita failed because no matching document id for {document}.")
+
+        (document_id, sid) = (KritaWsManager.instance().documents[document].document_id, KritaWsManager.instance().documents[document].sid)
+        json_payload = self.layer_request(document_id, layer, filename_prefix, **kwargs)
+        if live and len(json_payload.view_key()) == 2:
+            KritaWsManager.instance().subscribe_sync(document_id, layer, sid)
 
-            manager = ws_krita.KritaWsManager.instance()
-            manager.send_sync(json_payload, None, KritaWsManager.instance().documents[document][1])
+        manager = ws_krita.KritaWsManager.instance()
+        response = wait_for_krita(manager.get_layer_image_sync(json_payload, sid, timeout), timeout)
+        if not response.found:
+            raise Exception(f"Krita layer {layer} not found in {document}.")
+
+        preview_future = None
+        if preview:
+            # Results needed for preview in ComfyUI client, written while the pixels are converted
+            (preview_result, preview_future) = manager.save_preview(response, filename_prefix)
+
+        if response.image is None:
+            output_image, output_mask = raw_payload_to_tensors(response.payload, config.PIN_MEMORY)
         else:
-            print("GetImageKrita request skipped because no matching document id.")
+            output_image, output_mask = self.image_to_tensors(response.image)
+
+        if json_payload.mask != MaskSource.ALPHA:
+            if response.mask is not None:
+                # Selected is 1, the same way inpainting reads a mask
+                output_mask = torch.from_numpy(response.mask.astype(np.float32) / 255.0)[None,]
+            else:
+                # Nothing selected
+                output_mask = torch.zeros((1, output_image.shape[1], output_image.shape[2]), dtype=torch.float32, device="cpu")
 
-        start_time = time.time()
-        filepath = os.path.join(full_output_folder, file)
-        timeout = 10
-        while not os.path.exists(filepath):
-            if time.time() - start_time > timeout:
-                raise FileNotFoundError(f'{filepath} not found after {timeout} seconds')
-            time.sleep(0.1)
+        if preview_future is not None:
+            # The client fetches the preview as soon as it gets the entry, so the file has to exist by then
+            try:
+                preview_future.result()
+                results.append(preview_result)
+            except Exception as e:
+                print(f"Unable to write the preview of Krita layer {layer}: {e}")
+
+        return {
+            "ui": {
+                "images": results
+            },
+            "result": (output_image, output_mask, document)
+        }
 
+    @staticmethod
+    def image_to_tensors(img):
         # Below is from ComfyUI LoadImage node
-        img = node_helpers.pillow(Image.open, filepath)
 
         output_images = []
         output_masks = []
@@ -174,7 +373,7 @@ class GetImageKrita:
                 mask = np.array(i.getchannel('A')).astype(np.float32) / 255.0
                 mask = 1. - torch.from_numpy(mask)
             else:
-                mask = torch.zeros((64, 64), dtype=torch.float32, device="cpu")
+                mask = torch.zeros((h, w), dtype=torch.float32, device="cpu")
             output_images.append(image)
             output_masks.append(mask.unsqueeze(0))
 
@@ -185,18 +384,7 @@ class GetImageKrita:
             output_image = output_images[0]
             output_mask = output_masks[0]
 
-        # Results needed for preview in ComfyUI client
-        results.append({
-            "filename": file,
-            "subfolder": subfolder,
-            "type": "temp"
-        })
-        return {
-            "ui": {
-                "images": results
-            },
-            "result": (output_image, output_mask, document)
-        }
+        return output_image, output_mask
 
 
 class SelectKritaDocument:
@@ -1,65 +1,67 @@
-import io
-import os
 import uuid
-import folder_paths  # type: ignore
-from PIL import Image
 
-from ..krita_sync.cks_common.CksBinaryMessage import MessageType, GetImageKritaJsonPayload, DocumentSyncJsonPayload
+from ..krita_sync.cks_common.CksBinaryMessage import MessageType, DocumentSyncJsonPayload, CksPeerInfo, CksMessageAssembler, is_local_address
 from ..krita_sync.cks_common import CksBinaryMessage
 from server import PromptServer  # type: ignore
 from aiohttp import web, WSMsgType
-from . import ws_krita, nodes
+from . import ws_krita
 from typing import cast
 
 
+@PromptServer.instance.routes.get('/krita-sync/stats')
+async def krita_sync_stats_handler(request):
+    return web.json_response(ws_krita.KritaWsManager.instance().stats())
+
+
 @PromptServer.instance.routes.get('/krita-sync-ws')
 async def krita_websocket_handler(request):
     ws = web.WebSocketResponse(max_msg_size=2 ** 30)
     await ws.prepare(request)
     sid = request.rel_url.query.get('clientId', '')
     client_type = request.rel_url.query.get('clientType', '')
-    print(f"Client {sid} connected to krita-sync-ws as type {client_type}")
+    # Clients that predate the handshake don't send these and are treated as version 1
+    peer = CksPeerInfo.from_query(request.rel_url.query)
+    peer.local = is_local_address(request.remote)
+    print(f"Client {sid} connected to krita-sync-ws as type {client_type} (protocol version {peer.protocol_version})")
 
-    if sid:
-        # Reusing existing session, remove old
-        ws_krita.KritaWsManager.instance().sockets.pop(sid, None)
-    else:
+    if not sid:
         sid = uuid.uuid4().hex
-    ws_krita.KritaWsManager.instance().sockets[sid] = ws
+
+    # The handshake has to go out before anything the connection's sender task might send
+    if peer.protocol_version >= 2:
+        handshake_message = CksBinaryMessage(peer.handshake_payload())
+        await ws.send_bytes(handshake_message.encode_message(peer.protocol_version))
+
+    # Reusing an existing session replaces the old connection
+    connection = ws_krita.KritaWsManager.instance().add_connection(sid, ws, peer)
+
+    # Chunked messages are reassembled incrementally, so only one chunk per message is buffered at a time
+    assembler = CksMessageAssembler()
 
     try:
         async for msg in ws:
             if msg.type == WSMsgType.ERROR:
                 print('ws connection.py closed with exception %s' % ws.exception())
             else:
-                decoded_message = CksBinaryMessage.decode_message(msg.data)
-                json_payload = decoded_message.json_payload
-                if json_payload.type == MessageType.GetImageKrita:
-                    get_image_krita_payload = cast(GetImageKritaJsonPayload, json_payload)
-                    (_, byte_array) = decoded_message.payloads[0]
-                    image = Image.open(io.BytesIO(byte_array))
-                    filename_prefix = get_image_krita_payload.filename_prefix
-                    full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, folder_paths.get_temp_directory())
-                    file = f"{filename}_s.png"
-                    image.save(os.path.join(full_output_folder, file), compress_level=1)
-                    os.rename(os.path.join(full_output_folder, file), os.path.join(full_output_folder, f"{filename}_.png"))  # >:(
-                elif json_payload.type == MessageType.DocumentSync:
-                    document_sync_payload = cast(DocumentSyncJsonPayload, json_payload)
-                    base_map = {key: val for key, val in ws_krita.KritaWsManager.instance().documents.items() if val[1] != sid}
-                    for item in document_sync_payload.document_list:
-                        base_map[f"{item[1]} ({item[0].split('-')[0]})"] = (item[0], sid)
-                    ws_krita.KritaWsManager.instance().documents = base_map
-                    ws_krita.KritaWsManager.instance().document_combo = ["Missing Document"] + list(ws_krita.KritaWsManager.instance().documents.keys())
-                    nodes.update_node_return_types()
-                    PromptServer.instance.send_sync("cks_refresh", {})
+                # Only framing and dispatch happen here, anything expensive goes to the processing executor
+                for decoded_message in await ws_krita.KritaWsManager.instance().unpack(assembler, msg.data):
+                    handle_message(sid, decoded_message)
 
     finally:
         print(f"Client {sid} of type {client_type} disconnected from krita-sync-ws")
-        ws_krita.KritaWsManager.instance().sockets.pop(sid, None)
-        base_map = {key: val for key, val in ws_krita.KritaWsManager.instance().documents.items() if val[1] != sid}
-        ws_krita.KritaWsManager.instance().documents = base_map
-        ws_krita.KritaWsManager.instance().document_combo = ["Missing Document"] + list(ws_krita.KritaWsManager.instance().documents.keys())
-        nodes.update_node_return_types()
-        PromptServer.instance.send_sync("cks_refresh", {})
+        # A newer connection under the same clientId keeps its queue and the documents it synced
+        if ws_krita.KritaWsManager.instance().connections.get(sid) is connection:
+            ws_krita.KritaWsManager.instance().remove_connection(sid)
+            ws_krita.KritaWsManager.instance().remove_client_documents(sid)
 
     return ws
+
+
+def handle_message(sid, decoded_message):
+    json_payload = decoded_message.json_payload
+    if json_payload.type == MessageType.GetImageKrita:
+        ws_krita.KritaWsManager.instance().process_response(decoded_message)
+    elif json_payload.type == MessageType.LayerUpdate:
+        ws_krita.KritaWsManager.instance().process_layer_update(decoded_message)
+    elif json_payload.type == MessageType.DocumentSync:
+        ws_krita.KritaWsManager.instance().process_document_sync(sid, cast(DocumentSyncJsonPayload, json_payload))
@@ -1,14 +1,29 @@
 from __future__ import annotations
 
 import asyncio
+import collections
+import copy
+import itertools
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import IntEnum
 import struct
 import types
+import uuid
 from io import BytesIO
 
+import folder_paths  # type: ignore
+import numpy as np
+from PIL import Image
 from server import BinaryEventTypes, PromptServer, send_socket_catch_exception  # type: ignore
-from . import nodes
+from . import nodes, config
+from .image_cache import LayerImageCache
+from .document_registry import DocumentRegistry
 from ..krita_sync.cks_common import CksBinaryMessage
-from ..krita_sync.cks_common.CksBinaryMessage import CksJsonPayload, PayloadType
+from ..krita_sync.cks_common.CksBinaryMessage import CksJsonPayload, GetImageKritaJsonPayload, DocumentSyncJsonPayload, LayerSubscriptionJsonPayload, MessageType, PayloadType, CksPeerInfo, CksRawImage, ImageFormat, PayloadCompression, CksChunkEncoder, RAW_PIXEL_LAYOUTS, HIGH_BIT_DEPTH_PAYLOAD_TYPES, CAPABILITY_CHUNKED, CAPABILITY_SUBSCRIPTIONS, CAPABILITY_HIGH_BIT_DEPTH
 
 
 def encode_bytes(event, data):
@@ -21,13 +36,406 @@ def encode_bytes(event, data):
     return message
 
 
+@dataclass
+class OutgoingImage:
+    pixels: np.ndarray  # H x W x C uint8, usually a view into a whole converted batch
+    png: bytes | None = None  # Already encoded PNG, reused as is for clients that take PNG
+    # Same image in the layout of a 16-bit or float document, for clients that take high bit depth raw pixels. Only
+    # set on the copies OutgoingMessage makes once the batch is converted
+    deep_pixels: np.ndarray | None = None
+    deep_payload_type: PayloadType | None = None
+
+
+def encode_png(image: Image.Image, pnginfo=None, compress_level=6) -> bytes:
+    bytes_io = BytesIO()
+    image.save(bytes_io, format="PNG", pnginfo=pnginfo, compress_level=compress_level)
+    return bytes_io.getvalue()
+
+
+def encode_image_payload(outgoing_image: OutgoingImage, image_format: ImageFormat, high_bit_depth=False):
+    pixels = outgoing_image.pixels
+    if image_format == ImageFormat.PNG:
+        if outgoing_image.png is not None:
+            return PayloadType.PNG, outgoing_image.png
+        return PayloadType.PNG, encode_png(Image.fromarray(pixels))
+
+    if high_bit_depth and outgoing_image.deep_pixels is not None:
+        pixels = outgoing_image.deep_pixels
+        payload_type = outgoing_image.deep_payload_type
+    else:
+        payload_type = PayloadType.RAW_RGB if pixels.shape[2] == 3 else PayloadType.RAW_RGBA
+    if not pixels.flags.c_contiguous:
+        pixels = np.ascontiguousarray(pixels)
+    height, width = pixels.shape[:2]
+    compression = PayloadCompression.ZLIB if image_format == ImageFormat.RAW_ZLIB else PayloadCompression.NONE
+    # The pixels go on the wire straight from the batch buffer
+    raw_image = CksRawImage(width, height, pixels.strides[0], memoryview(pixels).cast('B'), compression=compression)
+    return payload_type, raw_image
+
+
+def save_png(image: Image.Image, pnginfo, path) -> bytes:
+    """
+    Encodes once and writes the same bytes to the temp folder, so the preview and the websocket share them.
+    """
+    png = encode_png(image, pnginfo, compress_level=1)
+    with open(path, "wb") as f:
+        f.write(png)
+    return png
+
+
+def decode_image_payload(payload) -> Image.Image:
+    (payload_type, content) = payload
+    if payload_type == PayloadType.PNG:
+        return Image.open(BytesIO(content))
+    elif payload_type == PayloadType.RAW_RGBA:
+        return Image.frombuffer("RGBA", (content.width, content.height), content.data, "raw", "RGBA", content.stride, 1)
+    elif payload_type == PayloadType.RAW_RGB:
+        return Image.frombuffer("RGB", (content.width, content.height), content.data, "raw", "RGB", content.stride, 1)
+    elif payload_type == PayloadType.RAW_ARGB32:
+        return Image.frombuffer("RGBA", (content.width, content.height), content.data, "raw", "BGRA", content.stride, 1)
+    elif payload_type in HIGH_BIT_DEPTH_PAYLOAD_TYPES:
+        # Pillow has no RGBA mode deeper than 8 bits, previews are squashed to 8-bit
+        pixels = raw_pixels(content, payload_type)
+        if payload_type == PayloadType.RAW_BGRA16:
+            pixels = pixels[:, :, [2, 1, 0, 3]] / 65535.0
+        pixels = (np.clip(pixels, 0.0, 1.0) * 255.0 + 0.5).astype(np.uint8)
+        return Image.fromarray(pixels, "RGBA")
+    raise ValueError(f"Unsupported image payload type: {payload_type}")
+
+
+def raw_pixels(content: CksRawImage, payload_type: PayloadType) -> np.ndarray:
+    """
+    H x W x channels view of a raw image payload in its own dtype, without copying.
+    """
+    layout = RAW_PIXEL_LAYOUTS[payload_type]
+    rows = np.frombuffer(content.data, dtype=np.uint8, count=content.stride * content.height)
+    row_pixels = rows.reshape(content.height, content.stride)[:, :content.width * layout.bytes_per_pixel]
+    # Little endian on the wire, as both Krita and numpy lay it out on every platform ComfyUI runs on
+    return row_pixels.view(np.dtype(layout.channel_format).newbyteorder("<")).reshape(content.height, content.width, len(layout.channel_order))
+
+
+def write_preview(response: KritaImageResponse, full_output_folder, file):
+    temp_path = os.path.join(full_output_folder, f"{file}.part")
+    if response.payload[0] == PayloadType.PNG:
+        # Krita already sent a PNG, no need to encode it again
+        with open(temp_path, "wb") as f:
+            f.write(response.payload[1])
+    else:
+        decode_image_payload(response.payload).save(temp_path, format="PNG", compress_level=1)
+    os.replace(temp_path, os.path.join(full_output_folder, file))
+
+
+@dataclass
+class KritaImageResponse:
+    json_payload: GetImageKritaJsonPayload
+    # Image payload as received. Raw pixels stay in the received buffer until a node turns them into tensors, and a
+    # PNG is kept so the preview doesn't encode it again
+    payload: tuple | None = None
+    image: Image.Image | None = None  # Decoded PNG payloads
+    tiles: list | None = None  # Changed tiles of a delta response as raw payloads, before they are applied
+    mask: np.ndarray | None = None  # H x W uint8 selection, when one was asked for and exists
+
+    @property
+    def found(self) -> bool:
+        return self.payload is not None
+
+
+def process_get_image_response(decoded_message) -> KritaImageResponse:
+    """
+    Runs on the processing executor, so the PNG decode never happens on the event loop or in the prompt. Raw
+    payloads need no decoding at all.
+    """
+    response = KritaImageResponse(decoded_message.json_payload)
+    image_payloads = []
+    for payload in decoded_message.payloads:
+        if payload[0] == PayloadType.MASK_8:
+            response.mask = raw_pixels(payload[1], PayloadType.MASK_8)[:, :, 0]
+        else:
+            image_payloads.append(payload)
+
+    if response.json_payload.base_revision:
+        response.tiles = image_payloads
+    elif len(image_payloads) > 0:
+        response.payload = image_payloads[0]
+        if response.payload[0] == PayloadType.PNG:
+            response.image = decode_image_payload(response.payload)
+            response.image.load()
+    return response
+
+
+def apply_tile_delta(base: KritaImageResponse, delta: KritaImageResponse) -> KritaImageResponse:
+    """
+    Builds the full layer from a cached response and the tiles that changed since. The cached pixels are left as is,
+    they may still be in use by a node.
+    """
+    if base.image is not None:
+        pixels = np.array(base.image.convert("RGBA"))
+        payload_type = PayloadType.RAW_RGBA
+    else:
+        (payload_type, content) = base.payload
+        if payload_type == PayloadType.RAW_RGB:
+            raise ValueError(f"Can't apply tiles to a {payload_type.name} layer")
+        pixels = raw_pixels(content, payload_type).copy()
+
+    for (tile_payload_type, tile) in delta.tiles:
+        tile_pixels = raw_pixels(tile, tile_payload_type)
+        if tile_payload_type != payload_type:
+            if (tile_payload_type, payload_type) != (PayloadType.RAW_ARGB32, PayloadType.RAW_RGBA):
+                raise ValueError(f"Can't apply {tile_payload_type.name} tiles to a {payload_type.name} layer")
+            # Krita sends 8-bit tiles in its own ARGB32 layout, B, G, R, A in memory
+            tile_pixels = tile_pixels[:, :, [2, 1, 0, 3]]
+        pixels[tile.y:tile.y + tile.height, tile.x:tile.x + tile.width] = tile_pixels
+
+    height, width = pixels.shape[:2]
+    patched = CksRawImage(width, height, pixels.strides[0], memoryview(pixels).cast('B'))
+    return KritaImageResponse(delta.json_payload, (payload_type, patched), mask=delta.mask)
+
+
+class LoopLagMonitor:
+    """
+    Tracks how long the shared event loop was blocked, both from the websocket handler's own inline work and as
+    the lateness of a periodic wakeup, which also catches anything else stalling the loop.
+    """
+    def __init__(self, loop, interval=0.1):
+        self.interval = interval
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.handler_seconds = 0.0
+        self.handler_max_seconds = 0.0
+        self.task = loop.create_task(self.run())
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+
+    def record_handler(self, seconds):
+        self.handler_seconds += seconds
+        self.handler_max_seconds = max(self.handler_max_seconds, seconds)
+
+    def stats(self):
+        return {
+            "loop_lag_max": self.max_lag,
+            "loop_lag_average": self.total_lag / self.samples if self.samples > 0 else 0.0,
+            "handler_blocked_total": self.handler_seconds,
+            "handler_blocked_max": self.handler_max_seconds
+        }
+
+
+class MessagePriority(IntEnum):
+    CONTROL = 0
+    REQUEST = 1  # GetImageKrita, a running prompt is waiting on these
+    RESULT = 2   # SendImageKrita batches
+    BULK = 3
+
+
+DEFAULT_PRIORITIES = {
+    MessageType.Handshake: MessagePriority.CONTROL,
+    MessageType.DocumentSync: MessagePriority.CONTROL,
+    MessageType.GetImageKrita: MessagePriority.REQUEST,
+    MessageType.LayerSubscription: MessagePriority.CONTROL,
+    MessageType.SendImageKrita: MessagePriority.RESULT,
+}
+
+
+class OutgoingMessage:
+    """
+    A message queued for one or more clients. Images are encoded at most once per image format and shared by
+    every client that wants that format.
+
+    deep_images returns the whole batch in the layout of a 16-bit or float document and its payload type, or None for
+    8-bit documents. It is called once, on an encode worker, when the first client that takes high bit depth raw
+    pixels needs it, so messages only sent as 8-bit or PNG never build the copy.
+    """
+    def __init__(self, json_payload: CksJsonPayload, image_data=None, priority: MessagePriority | None = None, deep_images=None):
+        self.json_payload = json_payload
+        self.image_data = [image if isinstance(image, OutgoingImage) else OutgoingImage(np.asarray(image)) for image in image_data or []]
+        self.priority = priority if priority is not None else DEFAULT_PRIORITIES.get(json_payload.type, MessagePriority.BULK)
+        self._deep_images = deep_images
+        self._deep_future = None
+        self._payload_futures = {}
+
+    def payload_futures(self, manager: KritaWsManager, image_format: ImageFormat, high_bit_depth=False):
+        key = (image_format, high_bit_depth)
+        if key not in self._payload_futures:
+            if high_bit_depth and image_format != ImageFormat.PNG and self._deep_images is not None:
+                if self._deep_future is None:
+                    self._deep_future = manager.loop.run_in_executor(manager.encode_executor, self._deep_images)
+                self._payload_futures[key] = [manager.loop.create_task(self._encode_deep(manager, index, image_format)) for index in range(len(self.image_data))]
+            else:
+                self._payload_futures[key] = [manager.loop.run_in_executor(manager.encode_executor, encode_image_payload, image, image_format, high_bit_depth) for image in self.image_data]
+        return self._payload_futures[key]
+
+    async def _encode_deep(self, manager: KritaWsManager, index, image_format: ImageFormat):
+        (deep_images, deep_payload_type) = await self._deep_future
+        image = self.image_data[index]
+        if deep_images is not None:
+            image = OutgoingImage(image.pixels, deep_pixels=deep_images[index], deep_payload_type=deep_payload_type)
+        return await manager.loop.run_in_executor(manager.encode_executor, encode_image_payload, image, image_format, True)
+
+
+class KritaConnection:
+    """
+    One connected client with its own bounded outgoing queues and sender task, so a slow client only ever
+    delays itself. Messages go out by priority, and a large message yields to more urgent ones between payloads.
+    """
+    def __init__(self, manager: KritaWsManager, sid, ws, peer: CksPeerInfo):
+        self.manager = manager
+        self.sid = sid
+        self.ws = ws
+        self.peer = peer
+        self.image_format = peer.select_image_format(config.IMAGE_FORMAT)
+        self.high_bit_depth = peer.supports(CAPABILITY_HIGH_BIT_DEPTH)
+        self.queues = {priority: collections.deque() for priority in MessagePriority}
+        self.dropped = 0
+        self.closing = False  # Disconnected for falling behind, nothing more is queued
+        self._streams = {priority: collections.deque() for priority in MessagePriority}  # Messages partially sent
+        self._ready = asyncio.Event()
+        self.task = manager.loop.create_task(self.sender_loop())
+
+    @property
+    def queue_depth(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def put(self, outgoing: OutgoingMessage) -> bool:
+        """
+        Queues a message, applying CKS_QUEUE_FULL_POLICY if the client is not keeping up. Returns False if the
+        message will not be delivered.
+        """
+        if self.closing:
+            return False
+        if self.queue_depth >= config.SEND_QUEUE_DEPTH:
+            # Everything queued is a result, a request or control traffic, so nothing is dropped to make room
+            if config.QUEUE_FULL_POLICY == "drop":
+                self.dropped += 1
+                print(f"Send queue for client {self.sid} is full, dropping message")
+                return False
+            else:
+                # Messages still queued for it are lost with the connection
+                print(f"Send queue for client {self.sid} is full, disconnecting it")
+                self.closing = True
+                self.manager.loop.create_task(self.ws.close(message=b"Send queue full"))
+                return False
+
+        self.queues[outgoing.priority].append(outgoing)
+        # Start encoding now, while the message waits its turn
+        outgoing.payload_futures(self.manager, self.image_format, self.high_bit_depth)
+        self._ready.set()
+        return True
+
+    def _next_priority(self):
+        for priority in MessagePriority:
+            if len(self._streams[priority]) > 0 or len(self.queues[priority]) > 0:
+                return priority
+        return None
+
+    async def sender_loop(self):
+        while True:
+            priority = self._next_priority()
+            if priority is None:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+
+            streams = self._streams[priority]
+            if len(streams) == 0:
+                streams.append(self._stream(self.queues[priority].popleft()))
+            # Send one more step of the oldest message at this priority, then look again for anything more urgent
+            try:
+                await streams[0].__anext__()
+            except StopAsyncIteration:
+                streams.popleft()
+            except Exception as e:
+                streams.popleft()
+                traceback.print_exception(type(e), e, e.__traceback__)
+
+    async def _stream(self, outgoing: OutgoingMessage):
+        """
+        Sends one message, yielding between payloads so the sender can switch to a more urgent message. Clients
+        that take chunks receive each payload as soon as it is encoded, and can tell interleaved messages apart
+        by message id.
+        """
+        payload_futures = outgoing.payload_futures(self.manager, self.image_format, self.high_bit_depth)
+
+        if not self.peer.supports(CAPABILITY_CHUNKED):
+            cks_message = CksBinaryMessage(outgoing.json_payload)
+            for payload_future in payload_futures:
+                while not await self._wait_for_payload(payload_future, outgoing.priority):
+                    yield
+                cks_message.add_payload(*payload_future.result())
+            await self.ws.send_bytes(cks_message.encode_message(self.peer.protocol_version))
+            return
+
+        chunk_encoder = CksChunkEncoder(next(self.manager.message_ids) & 0xFFFFFFFF, config.CHUNK_SIZE)
+        for chunk in chunk_encoder.begin(outgoing.json_payload, len(payload_futures)):
+            await self.ws.send_bytes(chunk)
+        for chunk in chunk_encoder.flush():
+            await self.ws.send_bytes(chunk)
+        for payload_future in payload_futures:
+            yield
+            while not await self._wait_for_payload(payload_future, outgoing.priority):
+                yield
+            for chunk in chunk_encoder.add_payload(*payload_future.result()) + chunk_encoder.flush():
+                await self.ws.send_bytes(chunk)
+        for chunk in chunk_encoder.finish():
+            await self.ws.send_bytes(chunk)
+
+    async def _wait_for_payload(self, payload_future, priority) -> bool:
+        """
+        Waits for a payload to finish encoding, or until another message is queued. Returns False when the stream
+        should give the sender a chance to switch to a more urgent message first.
+        """
+        if payload_future.done():
+            return True
+        if self._next_priority() < priority:
+            return False
+        # Messages queued before now are no more urgent than this one, only wake up for new ones
+        self._ready.clear()
+        ready_task = self.manager.loop.create_task(self._ready.wait())
+        try:
+            # The payload is shared with other clients, so waiting here must never cancel it
+            await asyncio.wait([payload_future, ready_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready_task.cancel()
+        return payload_future.done()
+
+    def close(self):
+        self.task.cancel()
+        for priority in MessagePriority:
+            self.queues[priority].clear()
+            self._streams[priority].clear()
+
+    def stats(self):
+        return {
+            "protocol_version": self.peer.protocol_version,
+            "image_format": self.image_format.value,
+            "queue_depth": self.queue_depth,
+            "queue_depth_by_priority": {priority.name: len(self.queues[priority]) for priority in MessagePriority},
+            "dropped": self.dropped
+        }
+
+
 class KritaWsManager:
     def __init__(self):
-        self.sockets = dict()
-        self.messages = asyncio.Queue()
+        self.connections = dict()  # sid -> KritaConnection
+        self.message_ids = itertools.count()
+        self.pending_requests = dict()  # request_id -> (GetImageKritaJsonPayload, asyncio.Future, sid)
+        # Image decoding and preview writes, kept off both the event loop and the executing prompt
+        self.executor = ThreadPoolExecutor(max_workers=config.PROCESSING_WORKERS, thread_name_prefix="cks_processing")
+        # Outgoing image encoding, Pillow releases the GIL while compressing so threads run in parallel
+        self.encode_executor = ThreadPoolExecutor(max_workers=config.ENCODE_WORKERS, thread_name_prefix="cks_encode")
         self.loop = PromptServer.instance.loop
-        self.publish_task = self.loop.create_task(self.publish_loop())
-        self.documents = dict()
+        self.loop_monitor = LoopLagMonitor(self.loop)
+        self.image_cache = LayerImageCache(config.IMAGE_CACHE_MB * 1024 * 1024, config.IMAGE_CACHE_MAX_AGE, config.PREFETCH_TTL, self.apply_tile_delta)
+        self.subscriptions = dict()  # (document_id, layer) -> (sid, last used)
+        self.loop.call_later(config.SUBSCRIPTION_TTL / 4, self.expire_subscriptions)
+        self.documents = DocumentRegistry()
+        self._refresh_handle = None  # Pending cks_refresh broadcast
         self.document_combo = ["Missing Document"]
         self.remote_documents = []
 
@@ -61,6 +469,8 @@ class KritaWsManager:
                         self.remote_documents.append(document_combo_item)
                         self.document_combo.append(document_combo_item)
                         nodes.update_node_return_types()
+                    if cls == "CKS_GetImageKrita":
+                        self.prefetch(inputs, prompt)
 
         return json_data
 
@@ -71,31 +481,241 @@ class KritaWsManager:
                 nodes.update_node_return_types()
         self.remote_documents = []
 
-    async def send(self, json_payload: CksJsonPayload, image_data=None, sid=None):
-        cks_message = CksBinaryMessage(json_payload)
+    def process_document_sync(self, sid, json_payload: DocumentSyncJsonPayload):
+        if json_payload.delta:
+            changed = self.documents.update(sid, json_payload.document_list, json_payload.removed)
+        else:
+            changed = self.documents.replace(sid, json_payload.document_list)
+        if changed:
+            self._documents_changed()
 
-        if image_data is not None:
-            for image in image_data:
-                bytes_io = BytesIO()
-                image.save(bytes_io, format="PNG")
-                cks_message.add_payload(PayloadType.PNG, bytes_io.getvalue())
+    def remove_client_documents(self, sid):
+        if self.documents.remove_client(sid):
+            self._documents_changed()
 
-        cks_message_bytes = cks_message.encode_message()
+    def _documents_changed(self):
+        self.document_combo = ["Missing Document"] + self.documents.names()
+        nodes.update_node_return_types()
+        # Every open tab refetches the node definitions on cks_refresh, so a burst of changes sends it once
+        if self._refresh_handle is None:
+            self._refresh_handle = self.loop.call_later(config.DOCUMENT_REFRESH_DELAY, self._send_refresh)
 
+    def _send_refresh(self):
+        self._refresh_handle = None
+        PromptServer.instance.send_sync("cks_refresh", {})
+
+    def add_connection(self, sid, ws, peer: CksPeerInfo) -> KritaConnection:
+        self.remove_connection(sid)
+        connection = KritaConnection(self, sid, ws, peer)
+        self.connections[sid] = connection
+        return connection
+
+    def remove_connection(self, sid):
+        connection = self.connections.pop(sid, None)
+        if connection is None:
+            return
+        connection.close()
+        # Nothing will answer requests sent to this client anymore
+        for (_, future, request_sid) in list(self.pending_requests.values()):
+            if request_sid == sid and not future.done():
+                future.set_exception(ConnectionError(f"Krita client {sid} disconnected"))
+        for (key, (subscription_sid, _)) in list(self.subscriptions.items()):
+            if subscription_sid == sid:
+                del self.subscriptions[key]
+                self.image_cache.live.discard(key)
+
+    def enqueue(self, outgoing: OutgoingMessage, sid=None) -> bool:
         if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await ws.send_bytes(cks_message_bytes)
-        elif sid in self.sockets:
-            await self.sockets[sid].send_bytes(cks_message_bytes)
+            connections = list(self.connections.values())
+        elif sid in self.connections:
+            connections = [self.connections[sid]]
+        else:
+            connections = []
+
+        delivered = False
+        for connection in connections:
+            delivered = connection.put(outgoing) or delivered
+        return delivered
+
+    async def request(self, json_payload: GetImageKritaJsonPayload, sid, timeout: float):
+        """
+        Sends a GetImageKrita request and waits for the matching response message.
+        """
+        future = self.loop.create_future()
+        self.pending_requests[json_payload.request_id] = (json_payload, future, sid)
+        try:
+            if not self.enqueue(OutgoingMessage(json_payload), sid):
+                raise ConnectionError(f"Unable to send GetImageKrita request to Krita client {sid}")
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending_requests.pop(json_payload.request_id, None)
 
-    def send_sync(self, json_payload: CksJsonPayload = None, image_data=None, sid=None):
+    def request_sync(self, json_payload: GetImageKritaJsonPayload, sid, timeout: float):
+        return asyncio.run_coroutine_threadsafe(self.request(json_payload, sid, timeout), self.loop)
+
+    async def get_layer_image(self, json_payload: GetImageKritaJsonPayload, sid, timeout: float, prefetch=False) -> KritaImageResponse:
+        """
+        Like request, but goes through the layer cache, so unchanged layers aren't transferred again and nodes
+        asking for the same layer at once share the request.
+        """
+        async def fetch(known_revision):
+            request_payload = copy.copy(json_payload)
+            request_payload.request_id = uuid.uuid4().hex
+            request_payload.known_revision = known_revision
+            return await self.request(request_payload, sid, timeout)
+
+        return await self.image_cache.get(json_payload.view_key(), fetch, prefetch)
+
+    def prefetch(self, inputs, prompt):
+        """
+        Starts fetching a layer a queued prompt will read, so it is already decoded when the node runs. The node still
+        revalidates it, which costs no pixels if the layer didn't change in the meantime.
+        """
+        if config.PREFETCH_TTL <= 0:
+            return
+        inputs = dict(inputs)
+        # Select Krita Document passes its combo value through, so the document it links to is known now
+        link = inputs.get("document")
+        if isinstance(link, list) and prompt.get(link[0], {}).get("class_type") == "CKS_SelectKritaDocument":
+            inputs["document"] = prompt[link[0]]["inputs"].get("document")
+        # Other linked inputs aren't known until execution, which only matters for those the request reads
+        linked = [name for (name, value) in inputs.items() if isinstance(value, list)]
+        if any(name in nodes.GetImageKrita.REQUEST_INPUTS for name in linked):
+            return
+        for name in linked:
+            del inputs[name]
+        if inputs.get("document") not in self.documents or "layer" not in inputs:
+            return
+        document = self.documents[inputs["document"]]
+        (document_id, sid) = (document.document_id, document.sid)
+        json_payload = nodes.GetImageKrita.layer_request(document_id, **inputs)
+        task = self.loop.create_task(self.get_layer_image(json_payload, sid, config.GET_IMAGE_TIMEOUT, prefetch=True))
+        # Failures are reported when the node itself fetches the layer
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def apply_tile_delta(self, base: KritaImageResponse, delta: KritaImageResponse) -> KritaImageResponse:
+        return await self.loop.run_in_executor(self.executor, apply_tile_delta, base, delta)
+
+    def subscribe(self, document_id, layer, sid):
+        """
+        Asks Krita to push updates of a layer, or keeps an existing subscription from expiring.
+        """
+        key = (document_id, layer)
+        connection = self.connections.get(sid)
+        if connection is None or not connection.peer.supports(CAPABILITY_SUBSCRIPTIONS):
+            return
+        subscription = self.subscriptions.get(key)
+        if subscription is None or subscription[0] != sid:
+            json_payload = LayerSubscriptionJsonPayload(document_id, layer, True, config.LIVE_UPDATE_INTERVAL, self.image_cache.revision(key))
+            if not self.enqueue(OutgoingMessage(json_payload), sid):
+                return
+        self.subscriptions[key] = (sid, time.monotonic())
+
+    def subscribe_sync(self, document_id, layer, sid):
+        self.loop.call_soon_threadsafe(self.subscribe, document_id, layer, sid)
+
+    def expire_subscriptions(self):
+        """
+        Unsubscribes layers no node has read for a while, so Krita stops snapshotting them.
+        """
+        now = time.monotonic()
+        for (key, (sid, last_used)) in list(self.subscriptions.items()):
+            if now - last_used > config.SUBSCRIPTION_TTL:
+                del self.subscriptions[key]
+                self.image_cache.live.discard(key)
+                self.enqueue(OutgoingMessage(LayerSubscriptionJsonPayload(key[0], key[1], active=False)), sid)
+        self.loop.call_later(config.SUBSCRIPTION_TTL / 4, self.expire_subscriptions)
+
+    def process_layer_update(self, decoded_message):
+        self.loop.create_task(self._process_layer_update(decoded_message))
+
+    async def _process_layer_update(self, decoded_message):
+        json_payload = decoded_message.json_payload
+        key = (json_payload.krita_document, json_payload.krita_layer)
+        try:
+            response = await self.loop.run_in_executor(self.executor, process_get_image_response, decoded_message)
+            if key in self.subscriptions:
+                await self.image_cache.update(key, response)
+        except Exception as e:
+            traceback.print_exception(type(e), e, e.__traceback__)
+            self.image_cache.live.discard(key)
+
+    def get_layer_image_sync(self, json_payload: GetImageKritaJsonPayload, sid, timeout: float):
+        return asyncio.run_coroutine_threadsafe(self.get_layer_image(json_payload, sid, timeout), self.loop)
+
+    async def unpack(self, assembler, data):
+        """
+        Turns one websocket message into CKS messages, on a worker thread if it is big enough to stall the loop.
+        """
+        if len(data) > config.INLINE_DECODE_LIMIT:
+            return await self.loop.run_in_executor(self.executor, assembler.feed, data)
+        start = time.perf_counter()
+        decoded_messages = assembler.feed(data)
+        self.loop_monitor.record_handler(time.perf_counter() - start)
+        return decoded_messages
+
+    def process_response(self, decoded_message):
+        self.loop.create_task(self._process_response(decoded_message))
+
+    async def _process_response(self, decoded_message):
+        try:
+            response = await self.loop.run_in_executor(self.executor, process_get_image_response, decoded_message)
+        except Exception as e:
+            self._fail_request(decoded_message.json_payload, e)
+            return
+        self.resolve_request(response)
+
+    def _find_request(self, json_payload):
+        request_id = json_payload.request_id
+        if not request_id:
+            # Clients that predate request ids drop the field but still echo the filename prefix
+            request_id = next((key for key, (pending_payload, _, _) in self.pending_requests.items() if pending_payload.filename_prefix == json_payload.filename_prefix), None)
+        if request_id not in self.pending_requests:
+            print(f"Discarding GetImageKrita response for unknown or expired request {request_id}")
+            return None
+        (_, future, _) = self.pending_requests[request_id]
+        if future.done():
+            return None
+        return future
+
+    def _fail_request(self, json_payload, exception):
+        future = self._find_request(json_payload)
+        if future is not None:
+            future.set_exception(exception)
+
+    def resolve_request(self, response: KritaImageResponse):
+        future = self._find_request(response.json_payload)
+        if future is not None:
+            future.set_result(response)
+
+    def save_preview(self, response: KritaImageResponse, filename_prefix):
+        """
+        Starts writing the preview for the ComfyUI client in the background. Returns its UI result entry and the future
+        of the write, which has to be done before the entry is handed to the client.
+        """
+        full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, folder_paths.get_temp_directory())
+        file = f"{filename}_.png"
+        future = self.executor.submit(write_preview, response, full_output_folder, file)
+        return {
+            "filename": file,
+            "subfolder": subfolder,
+            "type": "temp"
+        }, future
+
+    def send_sync(self, json_payload: CksJsonPayload = None, image_data=None, sid=None, deep_images=None):
         self.loop.call_soon_threadsafe(
-            self.messages.put_nowait,
-            (json_payload, image_data, sid)
+            self.enqueue,
+            OutgoingMessage(json_payload, image_data, deep_images=deep_images),
+            sid
         )
 
-    async def publish_loop(self):
-        while True:
-            msg = await self.messages.get()
-            await self.send(*msg)
+    def stats(self):
+        return {
+            "processing_workers": config.PROCESSING_WORKERS,
+            "encode_workers": config.ENCODE_WORKERS,
+            "pending_requests": len(self.pending_requests),
+            "clients": {sid: connection.stats() for sid, connection in self.connections.items()},
+            "image_cache": self.image_cache.stats(),
+            "subscriptions": len(self.subscriptions),
+            **self.loop_monitor.stats()
+        }
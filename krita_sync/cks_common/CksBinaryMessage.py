@@ -1,20 +1,131 @@
 import json
 import base64
+import ipaddress
+import struct
 import time
-from dataclasses import dataclass
-from enum import Enum, IntEnum
-from typing import List
+import zlib
+from dataclasses import dataclass, field
+from enum import Enum, IntEnum, IntFlag
+from typing import List, FrozenSet, Optional
+
+
+# Version 1 is the original text framing with base64 payloads, version 2 is the binary framing
+PROTOCOL_VERSION = 2
+CKS_MAGIC = b"CKS"
+
+# Optional protocol features, negotiated as the intersection of what both peers advertise
+CAPABILITY_RAW_IMAGE = "raw_image"
+CAPABILITY_CHUNKED = "chunked"
+CAPABILITY_TILE_DELTA = "tile_delta"
+CAPABILITY_SUBSCRIPTIONS = "subscriptions"
+CAPABILITY_HIGH_BIT_DEPTH = "high_bit_depth"
+CAPABILITY_DOCUMENT_DELTA = "document_delta"
+CAPABILITIES: FrozenSet[str] = frozenset({CAPABILITY_RAW_IMAGE, CAPABILITY_CHUNKED, CAPABILITY_TILE_DELTA, CAPABILITY_SUBSCRIPTIONS, CAPABILITY_HIGH_BIT_DEPTH, CAPABILITY_DOCUMENT_DELTA})
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+# Largest payload a stream decoder accepts, a 16384 x 16384 float RGBA image. Payloads split across chunks get a
+# buffer of the length their header announces, so this bounds what a broken or hostile peer can make us allocate
+MAX_PAYLOAD_SIZE = 1 << 32
+# Chunked messages a receiver reassembles at once, and seconds one may go without a chunk. Past either the oldest
+# are dropped, as a peer that reconnected or gave up on a message never sends the rest
+MAX_IN_FLIGHT_MESSAGES = 64
+IN_FLIGHT_TIMEOUT = 300.0
+
+# Frame header: magic, protocol version, flags, payload count (including the JSON payload)
+_FRAME_HEADER = struct.Struct(">3sBBI")
+# Chunk header: magic, protocol version, flags, message id, sequence number. The body is the next slice of a frame
+_CHUNK_HEADER = struct.Struct(">3sBBII")
+# Payload header: payload type, content length
+_PAYLOAD_HEADER = struct.Struct(">BQ")
+# Version 1 headers look like "PNG:1234,", anything longer than this is malformed
+_LEGACY_HEADER_WINDOW = 32
+# Raw image header: width, height, stride, x offset, y offset, compression
+_RAW_IMAGE_HEADER = struct.Struct(">IIIiiB")
+
+
+class FrameFlags(IntFlag):
+    NONE = 0
+    CHUNK = 1
 
 
 class PayloadType(IntEnum):
     JSON = 0
     PNG = 1
+    RAW_RGBA = 2    # 8-bit channels in R, G, B, A byte order
+    RAW_ARGB32 = 3  # QImage.Format_ARGB32 memory layout, which is B, G, R, A bytes on little endian
+    RAW_RGB = 4     # 8-bit channels in R, G, B byte order, no alpha
+    MASK_8 = 5      # Single 8-bit channel, 255 where selected
+    # Native layouts of Krita's RGBA color spaces above 8 bits, little endian
+    RAW_BGRA16 = 6
+    RAW_RGBA16F = 7
+    RAW_RGBA32F = 8
+
+
+@dataclass(frozen=True)
+class RawPixelLayout:
+    channel_order: str  # Channels in memory order
+    channel_format: str  # struct/array format of one channel
+    channel_size: int
+
+    @property
+    def bytes_per_pixel(self) -> int:
+        return len(self.channel_order) * self.channel_size
+
+
+RAW_PIXEL_LAYOUTS = {
+    PayloadType.RAW_RGBA: RawPixelLayout("RGBA", "B", 1),
+    PayloadType.RAW_ARGB32: RawPixelLayout("BGRA", "B", 1),
+    PayloadType.RAW_RGB: RawPixelLayout("RGB", "B", 1),
+    PayloadType.MASK_8: RawPixelLayout("A", "B", 1),
+    PayloadType.RAW_BGRA16: RawPixelLayout("BGRA", "H", 2),
+    PayloadType.RAW_RGBA16F: RawPixelLayout("RGBA", "e", 2),
+    PayloadType.RAW_RGBA32F: RawPixelLayout("RGBA", "f", 4),
+}
+
+RAW_IMAGE_PAYLOAD_TYPES = frozenset(RAW_PIXEL_LAYOUTS.keys())
+
+HIGH_BIT_DEPTH_PAYLOAD_TYPES = frozenset({PayloadType.RAW_BGRA16, PayloadType.RAW_RGBA16F, PayloadType.RAW_RGBA32F})
+
+# Raw layout of each Krita RGBA color depth (Document.colorDepth())
+COLOR_DEPTH_PAYLOAD_TYPES = {
+    "U8": PayloadType.RAW_ARGB32,
+    "U16": PayloadType.RAW_BGRA16,
+    "F16": PayloadType.RAW_RGBA16F,
+    "F32": PayloadType.RAW_RGBA32F,
+}
+
+
+class PayloadCompression(IntEnum):
+    NONE = 0
+    ZLIB = 1
+
+
+class ImageFormat(str, Enum):
+    AUTO = "auto"
+    PNG = "png"
+    RAW = "raw"
+    RAW_ZLIB = "raw_zlib"
+
+
+class ImageRegion(str, Enum):
+    DOCUMENT = "document"
+    SELECTION = "selection"  # Bounds of the active selection, the whole document without one
+    RECT = "rect"
+
+
+class MaskSource(str, Enum):
+    ALPHA = "alpha"                    # ComfyUI derives the mask from the layer's alpha, nothing extra is sent
+    SELECTION = "selection"            # Active selection
+    SELECTION_MASK = "selection_mask"  # Selection mask layer named by mask_layer
 
 
 class MessageType(IntEnum):
     SendImageKrita = 0
     GetImageKrita = 1
     DocumentSync = 2
+    Handshake = 3
+    LayerSubscription = 4
+    LayerUpdate = 5
 
 
 def deserialize_ignore_missing_keys(cls, payload_dict: dict):
@@ -46,6 +157,9 @@ class CksJsonPayload:
                 MessageType.SendImageKrita: SendImageKritaJsonPayload,
                 MessageType.GetImageKrita: GetImageKritaJsonPayload,
                 MessageType.DocumentSync: DocumentSyncJsonPayload,
+                MessageType.Handshake: HandshakeJsonPayload,
+                MessageType.LayerSubscription: LayerSubscriptionJsonPayload,
+                MessageType.LayerUpdate: LayerUpdateJsonPayload,
             }[payload_type]
         except KeyError:
             raise ValueError(f"Unsupported 'type' value: {payload_type}")
@@ -76,12 +190,43 @@ class GetImageKritaJsonPayload(CksJsonPayload):
     krita_document: str
     krita_layer: str
     filename_prefix: str
-
-    def __init__(self, krita_document: str, krita_layer: str, filename_prefix: str) -> None:
+    request_id: str
+    revision: str       # Content revision of the layer, set by Krita in its response
+    known_revision: str  # Revision the requester already has, Krita answers unchanged instead of resending it
+    unchanged: bool
+    base_revision: str  # When set, the payloads are only the tiles that changed since this revision
+    region: str  # ImageRegion
+    rect: List[int]  # x, y, width, height for ImageRegion.RECT
+    max_side: int  # Krita scales the region down to fit, 0 sends it as is
+    mask: str  # MaskSource, anything but alpha adds a MASK_8 payload after the image when there is a selection
+    mask_layer: str
+
+    def __init__(self, krita_document: str, krita_layer: str, filename_prefix: str, request_id: str = "",
+                 revision: str = "", known_revision: str = "", unchanged: bool = False, base_revision: str = "",
+                 region: str = ImageRegion.DOCUMENT.value, rect: Optional[List[int]] = None, max_side: int = 0,
+                 mask: str = MaskSource.ALPHA.value, mask_layer: str = "") -> None:
         super().__init__(MessageType.GetImageKrita)
         self.krita_document = krita_document
         self.krita_layer = krita_layer
         self.filename_prefix = filename_prefix
+        self.request_id = request_id
+        self.revision = revision
+        self.known_revision = known_revision
+        self.unchanged = unchanged
+        self.base_revision = base_revision
+        self.region = region
+        self.rect = rect if rect is not None else []
+        self.max_side = max_side
+        self.mask = mask
+        self.mask_layer = mask_layer
+
+    def view_key(self) -> tuple:
+        """
+        Identifies what the request returns. Whole, unscaled layers share the key used by LayerUpdate.
+        """
+        if self.region == ImageRegion.DOCUMENT and self.max_side <= 0 and self.mask == MaskSource.ALPHA:
+            return self.krita_document, self.krita_layer
+        return self.krita_document, self.krita_layer, self.region, tuple(self.rect), self.max_side, self.mask, self.mask_layer
 
     @classmethod
     def deserialize(cls, payload_dict: dict) -> 'GetImageKritaJsonPayload':
@@ -89,36 +234,238 @@ class GetImageKritaJsonPayload(CksJsonPayload):
 
 
 class DocumentSyncJsonPayload(CksJsonPayload):
-    document_list: [(str, str)]
+    document_list: [(str, str, str)]  # Document id, display name, color depth
+    delta: bool  # When set, document_list only holds documents opened or renamed since the last sync
+    removed: List[str]  # Ids of documents closed since the last sync, for deltas
 
-    def __init__(self, document_list: [(str, str)]):
+    def __init__(self, document_list: [(str, str, str)], delta: bool = False, removed: Optional[List[str]] = None):
         super().__init__(MessageType.DocumentSync)
         self.document_list = document_list
+        self.delta = delta
+        self.removed = removed if removed is not None else []
 
     @classmethod
     def deserialize(cls, payload_dict: dict) -> 'DocumentSyncJsonPayload':
         return deserialize_ignore_missing_keys(cls, payload_dict)
 
 
+class HandshakeJsonPayload(CksJsonPayload):
+    protocol_version: int
+    capabilities: List[str]
+
+    def __init__(self, protocol_version: int, capabilities: List[str]):
+        super().__init__(MessageType.Handshake)
+        self.protocol_version = protocol_version
+        self.capabilities = capabilities
+
+    @classmethod
+    def deserialize(cls, payload_dict: dict) -> 'HandshakeJsonPayload':
+        return deserialize_ignore_missing_keys(cls, payload_dict)
+
+
+class LayerSubscriptionJsonPayload(CksJsonPayload):
+    krita_document: str
+    krita_layer: str
+    active: bool         # False unsubscribes
+    interval: float      # Minimum seconds between updates
+    known_revision: str  # Revision ComfyUI already has, so the first update can be skipped or sent as a delta
+
+    def __init__(self, krita_document: str, krita_layer: str, active: bool = True, interval: float = 0.5, known_revision: str = ""):
+        super().__init__(MessageType.LayerSubscription)
+        self.krita_document = krita_document
+        self.krita_layer = krita_layer
+        self.active = active
+        self.interval = interval
+        self.known_revision = known_revision
+
+    @classmethod
+    def deserialize(cls, payload_dict: dict) -> 'LayerSubscriptionJsonPayload':
+        return deserialize_ignore_missing_keys(cls, payload_dict)
+
+
+class LayerUpdateJsonPayload(CksJsonPayload):
+    """
+    Pushed by Krita for subscribed layers. Payloads are laid out like a GetImageKrita response.
+    """
+    krita_document: str
+    krita_layer: str
+    revision: str
+    base_revision: str
+    unchanged: bool
+
+    def __init__(self, krita_document: str, krita_layer: str, revision: str = "", base_revision: str = "", unchanged: bool = False):
+        super().__init__(MessageType.LayerUpdate)
+        self.krita_document = krita_document
+        self.krita_layer = krita_layer
+        self.revision = revision
+        self.base_revision = base_revision
+        self.unchanged = unchanged
+
+    def view_key(self) -> tuple:
+        return self.krita_document, self.krita_layer
+
+    @classmethod
+    def deserialize(cls, payload_dict: dict) -> 'LayerUpdateJsonPayload':
+        return deserialize_ignore_missing_keys(cls, payload_dict)
+
+
+@dataclass
+class CksPeerInfo:
+    """
+    What the other end of a connection understands. Peers that never advertised anything are version 1.
+    """
+    protocol_version: int = 1
+    capabilities: FrozenSet[str] = field(default_factory=frozenset)
+    local: bool = False
+
+    def supports(self, capability: str) -> bool:
+        return capability in self.capabilities
+
+    def select_image_format(self, preference: ImageFormat = ImageFormat.AUTO) -> ImageFormat:
+        """
+        Raw pixels skip the PNG codec, which is by far the bigger cost on loopback. Remote peers get PNG by default.
+        """
+        if not self.supports(CAPABILITY_RAW_IMAGE):
+            return ImageFormat.PNG
+        if preference != ImageFormat.AUTO:
+            return preference
+        return ImageFormat.RAW if self.local else ImageFormat.PNG
+
+    def query_string(self) -> str:
+        return f"cksVersion={self.protocol_version}&cksCapabilities={','.join(sorted(self.capabilities))}"
+
+    def handshake_payload(self) -> HandshakeJsonPayload:
+        return HandshakeJsonPayload(self.protocol_version, sorted(self.capabilities))
+
+    @classmethod
+    def own(cls) -> 'CksPeerInfo':
+        return cls(PROTOCOL_VERSION, CAPABILITIES)
+
+    @classmethod
+    def negotiate(cls, protocol_version: int, capabilities) -> 'CksPeerInfo':
+        return cls(min(int(protocol_version), PROTOCOL_VERSION), frozenset(capabilities) & CAPABILITIES)
+
+    @classmethod
+    def from_query(cls, query) -> 'CksPeerInfo':
+        try:
+            protocol_version = int(query.get('cksVersion', 1))
+        except ValueError:
+            protocol_version = 1
+        capabilities = [capability for capability in query.get('cksCapabilities', '').split(',') if capability]
+        return cls.negotiate(protocol_version, capabilities)
+
+
+def is_local_address(host: Optional[str]) -> bool:
+    if host is None:
+        return False
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host.strip("[]")).is_loopback
+    except ValueError:
+        return False
+
+
+@dataclass
+class CksRawImage:
+    """
+    Uncompressed pixels plus the metadata needed to interpret them. The channel layout is given by the payload type.
+    """
+    width: int
+    height: int
+    stride: int
+    data: bytes
+    x: int = 0
+    y: int = 0
+    compression: PayloadCompression = PayloadCompression.NONE
+
+    def encode_parts(self) -> list:
+        data = self.data
+        if self.compression == PayloadCompression.ZLIB:
+            data = zlib.compress(data, 1)
+        header = _RAW_IMAGE_HEADER.pack(self.width, self.height, self.stride, self.x, self.y, self.compression)
+        return [header, data]
+
+    @classmethod
+    def decode(cls, content) -> 'CksRawImage':
+        if len(content) < _RAW_IMAGE_HEADER.size:
+            raise ValueError("Truncated raw image header")
+        width, height, stride, x, y, compression = _RAW_IMAGE_HEADER.unpack_from(content, 0)
+        compression = PayloadCompression(compression)
+        data = content[_RAW_IMAGE_HEADER.size:]
+        if compression == PayloadCompression.ZLIB:
+            data = zlib.decompress(data)
+        if len(data) < stride * height:
+            raise ValueError(f"Raw image data too short for {width}x{height} with stride {stride}")
+        # Pixels are always handed out uncompressed
+        return cls(width, height, stride, data, x, y)
+
+
+def _frame_parts(json_payload: CksJsonPayload, payload_count: int) -> list:
+    encoded_json_content = json_payload.serialize().encode('utf-8')
+    return [
+        _FRAME_HEADER.pack(CKS_MAGIC, PROTOCOL_VERSION, FrameFlags.NONE, payload_count + 1),
+        _PAYLOAD_HEADER.pack(PayloadType.JSON, len(encoded_json_content)),
+        encoded_json_content
+    ]
+
+
+def _payload_parts(payload_type: PayloadType, content) -> list:
+    if payload_type == PayloadType.PNG:
+        content_parts = [content]
+    elif payload_type in RAW_IMAGE_PAYLOAD_TYPES:
+        content_parts = content.encode_parts()
+    else:
+        raise ValueError("Unsupported payload type")
+    content_length = sum(memoryview(part).nbytes for part in content_parts)
+    return [_PAYLOAD_HEADER.pack(payload_type, content_length)] + content_parts
+
+
 class CksBinaryMessage:
     def __init__(self, json_payload: CksJsonPayload):
         self.json_payload: CksJsonPayload = json_payload
         self.payloads: [(PayloadType, bytes)] = []
 
-    def add_payload(self, payload_type: PayloadType, content: bytes):
+    def add_payload(self, payload_type: PayloadType, content):
         """
-        Adds a payload to the message. Supports PayloadType.PNG.
+        Adds a payload to the message. Supports PayloadType.PNG and the raw image types.
         """
         if payload_type == PayloadType.PNG:
             # content must be raw PNG bytes
             self.payloads.append((PayloadType.PNG, content))
+        elif payload_type in RAW_IMAGE_PAYLOAD_TYPES:
+            if not isinstance(content, CksRawImage):
+                raise ValueError("Raw image payloads must be CksRawImage")
+            self.payloads.append((payload_type, content))
         else:
             raise ValueError("Unsupported payload type")
 
-    def encode_message(self):
+    def encode_message(self, protocol_version: int = PROTOCOL_VERSION):
         """
-        Encodes the message to binary format.
+        Encodes the message to binary format. Pass the negotiated version when talking to an older peer.
         """
+        if protocol_version < 2:
+            return self._encode_message_v1()
+
+        message_parts = _frame_parts(self.json_payload, len(self.payloads))
+        for payload_type, content in self.payloads:
+            message_parts.extend(_payload_parts(payload_type, content))
+
+        return b''.join(message_parts)
+
+    def encode_chunks(self, message_id: int, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        Encodes the message as a sequence of chunks no larger than chunk_size plus the chunk header.
+        Only for peers that support CAPABILITY_CHUNKED. Chunks are built one at a time as they are consumed, so
+        sending them as they come never holds a second copy of the message.
+        """
+        chunk_encoder = CksChunkEncoder(message_id, chunk_size)
+        yield from chunk_encoder.iter_parts(_frame_parts(self.json_payload, len(self.payloads)))
+        for payload_type, content in self.payloads:
+            yield from chunk_encoder.iter_parts(_payload_parts(payload_type, content))
+        yield from chunk_encoder.finish()
+
+    def _encode_message_v1(self):
         message_parts = []
 
         # Always put the json payload first
@@ -146,8 +493,22 @@ class CksBinaryMessage:
     @classmethod
     def decode_message(cls, binary_data) -> 'CksBinaryMessage':
         """
-        Decodes a binary message back to its original form.
+        Decodes a binary message back to its original form. Both framing versions are accepted.
         """
+        if binary_data[:len(CKS_MAGIC)] == CKS_MAGIC:
+            return cls._decode_message_v2(binary_data)
+        return cls._decode_message_v1(binary_data)
+
+    @classmethod
+    def _decode_message_v2(cls, binary_data) -> 'CksBinaryMessage':
+        decoder = CksStreamDecoder()
+        decoded_messages = decoder.feed(binary_data)
+        if len(decoded_messages) != 1 or decoder.in_progress:
+            raise ValueError("Binary data must contain exactly one complete message")
+        return decoded_messages[0]
+
+    @classmethod
+    def _decode_message_v1(cls, binary_data) -> 'CksBinaryMessage':
         idx = 0
         decoded_message: CksBinaryMessage | None = None
 
@@ -155,13 +516,15 @@ class CksBinaryMessage:
             binary_data = memoryview(binary_data)
 
         while idx < len(binary_data):
-            # Find the next header
-            header_end = binary_data[idx:].tobytes().find(b':')
+            # Find the next header, only looking at a small window so this stays linear in message size
+            header_end = binary_data[idx:idx + _LEGACY_HEADER_WINDOW].tobytes().find(b':')
+            if header_end == -1:
+                raise ValueError("Malformed payload header")
             type_str = binary_data[idx:idx + header_end].tobytes().decode('utf-8')
             payload_type = PayloadType[type_str]
 
             content_length_start = idx + header_end + 1
-            content_length_end = binary_data[content_length_start:].tobytes().find(b',')
+            content_length_end = binary_data[content_length_start:content_length_start + _LEGACY_HEADER_WINDOW].tobytes().find(b',')
             if content_length_end == -1:
                 content_length_end = len(binary_data) - content_length_start
 
@@ -169,11 +532,11 @@ class CksBinaryMessage:
 
             content_start = content_length_start + content_length_end + 1
             content_end = content_start + content_length
-            content = binary_data[content_start:content_end].tobytes()
+            content = binary_data[content_start:content_end]
 
             if payload_type == PayloadType.JSON:
                 if decoded_message is None:
-                    decoded_content = CksJsonPayload.deserialize(content.decode('utf-8'))
+                    decoded_content = CksJsonPayload.deserialize(str(content, 'utf-8'))
                     decoded_message = cls(decoded_content)
                 else:
                     raise ValueError("More than one JSON payload was present in the message")
@@ -192,3 +555,238 @@ class CksBinaryMessage:
             raise ValueError("Unable to decode message from binary data")
 
         return decoded_message
+
+
+class CksStreamDecoder:
+    """
+    Incremental decoder for version 2 frames. Data can be fed in arbitrary chunks as it arrives and complete
+    messages are returned as soon as their last payload is in. Payloads are memoryviews into the fed data when
+    they arrive in one piece, or into a single buffer allocated for them when they span several chunks.
+    """
+    def __init__(self, payload_callback=None, max_payload_size=MAX_PAYLOAD_SIZE):
+        # Called as payload_callback(message, payload_type, content) for each image payload as soon as it is complete
+        self._payload_callback = payload_callback
+        self._max_payload_size = max_payload_size
+        self._header = bytearray()
+        self._message: CksBinaryMessage | None = None
+        self._remaining_payloads = 0
+        self._payload_type: PayloadType | None = None
+        self._content: bytearray | None = None
+        self._content_filled = 0
+
+    @property
+    def in_progress(self) -> bool:
+        """
+        True while a frame has been started but not completed.
+        """
+        return self._remaining_payloads > 0 or len(self._header) > 0
+
+    def feed(self, data) -> List[CksBinaryMessage]:
+        """
+        Consumes the next chunk of the stream, returning any messages it completed.
+        """
+        view = memoryview(data).cast('B')
+        decoded_messages = []
+        idx = 0
+
+        while idx < len(view):
+            if self._remaining_payloads == 0:
+                idx, header = self._read_header(view, idx, _FRAME_HEADER.size)
+                if header is None:
+                    break
+                magic, version, flags, payload_count = _FRAME_HEADER.unpack(header)
+                if magic != CKS_MAGIC or version < 2 or flags != FrameFlags.NONE:
+                    raise ValueError(f"Invalid frame header: {magic}, version {version}, flags {flags}")
+                if payload_count == 0:
+                    raise ValueError("Frame without JSON payload")
+                self._remaining_payloads = payload_count
+                self._message = None
+            elif self._payload_type is None:
+                idx, header = self._read_header(view, idx, _PAYLOAD_HEADER.size)
+                if header is None:
+                    break
+                type_value, content_length = _PAYLOAD_HEADER.unpack(header)
+                if content_length > self._max_payload_size:
+                    raise ValueError(f"Payload of {content_length} bytes is larger than the {self._max_payload_size} allowed")
+                self._payload_type = PayloadType(type_value)
+                if content_length > len(view) - idx:
+                    self._content = bytearray(content_length)
+                    self._content_filled = 0
+                else:
+                    # Whole payload is already here, hand out a view of it without copying
+                    decoded_message = self._complete_payload(view[idx:idx + content_length])
+                    idx += content_length
+                    if decoded_message is not None:
+                        decoded_messages.append(decoded_message)
+            else:
+                count = min(len(self._content) - self._content_filled, len(view) - idx)
+                self._content[self._content_filled:self._content_filled + count] = view[idx:idx + count]
+                self._content_filled += count
+                idx += count
+                if self._content_filled == len(self._content):
+                    content = memoryview(self._content)
+                    self._content = None
+                    decoded_message = self._complete_payload(content)
+                    if decoded_message is not None:
+                        decoded_messages.append(decoded_message)
+
+        return decoded_messages
+
+    def _read_header(self, view, idx, size):
+        if len(self._header) == 0 and len(view) - idx >= size:
+            return idx + size, view[idx:idx + size]
+        count = min(size - len(self._header), len(view) - idx)
+        self._header += view[idx:idx + count]
+        if len(self._header) < size:
+            return idx + count, None
+        header = bytes(self._header)
+        self._header.clear()
+        return idx + count, header
+
+    def _complete_payload(self, content) -> Optional[CksBinaryMessage]:
+        payload_type = self._payload_type
+        self._payload_type = None
+        self._remaining_payloads -= 1
+
+        if payload_type == PayloadType.JSON:
+            if self._message is not None:
+                raise ValueError("More than one JSON payload was present in the message")
+            self._message = CksBinaryMessage(CksJsonPayload.deserialize(str(content, 'utf-8')))
+        elif payload_type == PayloadType.PNG:
+            if self._message is None:
+                raise ValueError("No JSON payload present before image payloads")
+            self._message.payloads.append((payload_type, content))
+        elif payload_type in RAW_IMAGE_PAYLOAD_TYPES:
+            if self._message is None:
+                raise ValueError("No JSON payload present before image payloads")
+            content = CksRawImage.decode(content)
+            self._message.payloads.append((payload_type, content))
+        else:
+            raise ValueError(f"Unsupported payload type: {payload_type}")
+
+        if payload_type != PayloadType.JSON and self._payload_callback is not None:
+            self._payload_callback(self._message, payload_type, content)
+
+        if self._remaining_payloads > 0:
+            return None
+        decoded_message = self._message
+        self._message = None
+        return decoded_message
+
+
+class CksChunkEncoder:
+    """
+    Splits one message into chunks as its payloads become available, so a sender never has to hold more than
+    chunk_size of framing in memory and can start sending before the last payload is ready.
+    """
+    def __init__(self, message_id: int, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        self.message_id = message_id
+        self._chunk_size = max(1, chunk_size)
+        self._sequence = 0
+        self._pending = []
+        self._pending_size = 0
+
+    def begin(self, json_payload: CksJsonPayload, payload_count: int) -> List[bytes]:
+        return self._add_parts(_frame_parts(json_payload, payload_count))
+
+    def add_payload(self, payload_type: PayloadType, content) -> List[bytes]:
+        return self._add_parts(_payload_parts(payload_type, content))
+
+    def flush(self) -> List[bytes]:
+        """
+        Sends whatever is pending as a short chunk, so a completed payload doesn't wait for the next one.
+        """
+        if self._pending_size == 0:
+            return []
+        return [self._flush()]
+
+    def finish(self) -> List[bytes]:
+        return self.flush()
+
+    def iter_parts(self, parts):
+        """
+        Yields the chunks completed by parts one at a time, building each only when the previous one was taken.
+        """
+        for part in parts:
+            view = memoryview(part).cast('B')
+            idx = 0
+            while idx < len(view):
+                count = min(self._chunk_size - self._pending_size, len(view) - idx)
+                self._pending.append(view[idx:idx + count])
+                self._pending_size += count
+                idx += count
+                if self._pending_size == self._chunk_size:
+                    yield self._flush()
+
+    def _add_parts(self, parts) -> List[bytes]:
+        return list(self.iter_parts(parts))
+
+    def _flush(self) -> bytes:
+        header = _CHUNK_HEADER.pack(CKS_MAGIC, PROTOCOL_VERSION, FrameFlags.CHUNK, self.message_id, self._sequence)
+        chunk = b''.join([header] + self._pending)
+        self._sequence += 1
+        self._pending = []
+        self._pending_size = 0
+        return chunk
+
+
+class CksMessageAssembler:
+    """
+    Receiving side of a connection. Accepts whole messages of either framing version as well as chunks, keeping one
+    stream decoder per in-flight message id so chunks of different messages may be interleaved. Messages that stop
+    receiving chunks are dropped when a new one starts, once they are the oldest of max_in_flight or have waited
+    stale_after seconds.
+    """
+    def __init__(self, payload_callback=None, max_payload_size=MAX_PAYLOAD_SIZE, max_in_flight=MAX_IN_FLIGHT_MESSAGES,
+                 stale_after=IN_FLIGHT_TIMEOUT):
+        self._payload_callback = payload_callback
+        self._max_payload_size = max_payload_size
+        self._max_in_flight = max_in_flight
+        self._stale_after = stale_after
+        # message id -> (CksStreamDecoder, next sequence number, time of the last chunk), least recently fed first
+        self._decoders = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._decoders)
+
+    def feed(self, data) -> List[CksBinaryMessage]:
+        """
+        Consumes one websocket message, returning any CKS messages it completed.
+        """
+        if data[:len(CKS_MAGIC)] != CKS_MAGIC or len(data) < _CHUNK_HEADER.size:
+            return [CksBinaryMessage.decode_message(data)]
+        magic, version, flags = _FRAME_HEADER.unpack_from(data, 0)[:3]
+        if not flags & FrameFlags.CHUNK:
+            if self._payload_callback is None:
+                return [CksBinaryMessage.decode_message(data)]
+            decoder = CksStreamDecoder(self._payload_callback, self._max_payload_size)
+            decoded_messages = decoder.feed(data)
+            if len(decoded_messages) != 1 or decoder.in_progress:
+                raise ValueError("Binary data must contain exactly one complete message")
+            return decoded_messages
+
+        magic, version, flags, message_id, sequence = _CHUNK_HEADER.unpack_from(data, 0)
+        now = time.monotonic()
+        decoder, expected_sequence, _ = self._decoders.pop(message_id, (None, 0, now))
+        if sequence != expected_sequence:
+            raise ValueError(f"Chunk {sequence} of message {message_id} arrived out of order, expected {expected_sequence}")
+        if decoder is None:
+            self._evict_stale(now)
+            decoder = CksStreamDecoder(self._payload_callback, self._max_payload_size)
+
+        decoded_messages = decoder.feed(memoryview(data)[_CHUNK_HEADER.size:])
+        if decoder.in_progress:
+            # Reinserted, so the dict stays ordered by the last chunk
+            self._decoders[message_id] = (decoder, sequence + 1, now)
+        return decoded_messages
+
+    def _evict_stale(self, now):
+        """
+        Drops the least recently fed messages while they are too many to start another, or too old.
+        """
+        while len(self._decoders) > 0:
+            (message_id, (_, _, last_chunk)) = next(iter(self._decoders.items()))
+            if len(self._decoders) < self._max_in_flight and now - last_chunk <= self._stale_after:
+                break
+            del self._decoders[message_id]
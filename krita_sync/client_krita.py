@@ -1,17 +1,27 @@
 from __future__ import annotations
 
+import array
 import asyncio
+import itertools
+import queue
+import struct
+import threading
 import uuid
+import zlib
+from urllib.parse import urlparse
 from collections import OrderedDict
 from copy import copy
+from dataclasses import dataclass
 from enum import IntEnum
 
-from PyQt5.QtCore import QThread, pyqtSignal, QObject, QByteArray, QBuffer, QIODevice
+from PyQt5.QtCore import Qt, QThread, pyqtSignal, QObject, QByteArray, QBuffer, QIODevice, QTimer, QRunnable, QThreadPool
 from PyQt5.QtGui import QImage
 from krita import Krita  # type: ignore
 
-from .cks_common.CksBinaryMessage import CksBinaryMessage, PayloadType, MessageType, GetImageKritaJsonPayload, DocumentSyncJsonPayload, SendImageKritaJsonPayload
-from krita_sync.util import get_document_name
+from .cks_common.CksBinaryMessage import CksBinaryMessage, PayloadType, RAW_PIXEL_LAYOUTS, COLOR_DEPTH_PAYLOAD_TYPES, CAPABILITY_HIGH_BIT_DEPTH, MessageType, GetImageKritaJsonPayload, DocumentSyncJsonPayload, SendImageKritaJsonPayload, HandshakeJsonPayload, LayerSubscriptionJsonPayload, LayerUpdateJsonPayload, CksPeerInfo, CksRawImage, ImageFormat, ImageRegion, MaskSource, PayloadCompression, CksMessageAssembler, is_local_address, CAPABILITY_CHUNKED, CAPABILITY_TILE_DELTA, CAPABILITY_DOCUMENT_DELTA, DEFAULT_CHUNK_SIZE
+from krita_sync.util import get_document_id, get_document_name, read_setting, read_int_setting
+from krita_sync.layer_index import LayerIndex
+from krita_sync.image_store import ImageStore, DeepImage
 from .websockets.src.websockets import client as ws_client
 import traceback
 from typing import cast
@@ -21,6 +31,40 @@ def _print_exception_trace(exception):
     traceback.print_exception(type(exception), exception, exception.__traceback__)
 
 
+# Edge length of the tiles compared when answering GetImageKrita with a delta
+_DELTA_TILE_SIZE = 64
+_DOCUMENT_SYNC_DELAY_MS = 100
+# Encoded websocket frames of one message a worker may get ahead of the sending before it waits
+_FRAMES_AHEAD = 2
+
+
+@dataclass
+class LayerSnapshot:
+    """
+    Pixels as read on the GUI thread. _finish_snapshot scales and converts them to what is sent, and sets the
+    revision, on a worker thread.
+    """
+    width: int
+    height: int
+    pixel_data: bytes  # Laid out as payload_type
+    payload_type: PayloadType = PayloadType.RAW_ARGB32
+    mask: bytes | None = None  # 8-bit selection, same size as the pixels
+    mask_stride: int = 0
+    send_payload_type: PayloadType = PayloadType.RAW_ARGB32
+    max_side: int = 0  # The longer side is scaled down to this, 0 keeps the size
+    revision: str = ""  # Empty until finished
+
+
+@dataclass
+class LayerSubscription:
+    interval: float
+    pushed_revision: str  # Revision ComfyUI has, the one it subscribed with until the first update goes out
+    first_update: bool = True
+    seen_revision: str = ""
+    gone: bool = False  # ComfyUI was told the layer is missing
+    encoding: bool = False  # The last snapshot is still being checked or encoded on a worker
+
+
 class ConnectionState(IntEnum):
     Disconnected = 0
     Connected = 1
@@ -37,27 +81,340 @@ class LoopThread(QThread):
         self._loop.run_forever()
 
 
-def _extract_message_png_image(payload):
+# QImage format matching each raw layout, and whether R and B have to be swapped to get there. Qt 5 has no float
+# formats, float pixels are passed through as bytes and only turned into 8-bit for display or for peers without
+# high bit depth
+_QIMAGE_LAYOUTS = {
+    PayloadType.RAW_ARGB32: (QImage.Format.Format_ARGB32, False),
+    PayloadType.RAW_BGRA16: (QImage.Format.Format_RGBA64, True),
+}
+_FLOAT_PAYLOAD_TYPES = frozenset({PayloadType.RAW_RGBA16F, PayloadType.RAW_RGBA32F})
+_FLOAT_TO_8BIT_TABLES = {}  # Payload type -> 8-bit value of every 16-bit pattern
+
+
+def _native_payload_type(document):
+    if document.colorModel() != "RGBA":
+        return PayloadType.RAW_ARGB32
+    return COLOR_DEPTH_PAYLOAD_TYPES.get(document.colorDepth(), PayloadType.RAW_ARGB32)
+
+
+def _transfer_depth(document):
+    """
+    Color depth ComfyUI should send images for this document in, the depth of the document when it has a raw layout.
+    """
+    return document.colorDepth() if _native_payload_type(document) != PayloadType.RAW_ARGB32 else "U8"
+
+
+def _float_to_8bit_table(payload_type) -> bytes:
+    """
+    8-bit value of every 16-bit pattern: a half float for RAW_RGBA16F, the upper half of a float for RAW_RGBA32F.
+    """
+    table = _FLOAT_TO_8BIT_TABLES.get(payload_type)
+    if table is None:
+        (float_format, padding) = ("<e", b"") if payload_type == PayloadType.RAW_RGBA16F else ("<f", b"\0\0")
+        values = []
+        for pattern in range(1 << 16):
+            (value,) = struct.unpack(float_format, padding + pattern.to_bytes(2, "little"))
+            # NaN fails both comparisons and ends up 0
+            values.append(255 if value >= 1.0 else int(value * 255.0 + 0.5) if value > 0.0 else 0)
+        table = bytes(values)
+        _FLOAT_TO_8BIT_TABLES[payload_type] = table
+    return table
+
+
+def _float_to_argb32(pixel_data, payload_type) -> bytes:
+    """
+    ARGB32 pixels from packed RGBA float ones, clamped to 0..1 with no color management. Every channel goes through
+    a lookup table, so the per pixel work stays in C loops without numpy, a few seconds for a 4K image. Floats are
+    cut to their upper 16 bits first, still more precision than 8 bits can show.
+    """
+    pixel_data = bytes(pixel_data)
+    if payload_type == PayloadType.RAW_RGBA32F:
+        patterns = bytearray(len(pixel_data) // 2)
+        patterns[0::2] = pixel_data[2::4]
+        patterns[1::2] = pixel_data[3::4]
+    else:
+        patterns = pixel_data
+    # Little endian, as on every platform Krita runs on
+    values = array.array("H")
+    values.frombytes(patterns)
+    pixels = bytearray(map(_float_to_8bit_table(payload_type).__getitem__, values))
+    pixels[0::4], pixels[2::4] = pixels[2::4], pixels[0::4]
+    return bytes(pixels)
+
+
+def _raw_to_qimage(pixel_data, width, height, payload_type):
+    """
+    QImage over pixels in a raw layout. Copies when R and B need swapping, so the result may outlive pixel_data then.
+    """
+    (image_format, swap) = _QIMAGE_LAYOUTS[payload_type]
+    image = QImage(pixel_data, width, height, width * RAW_PIXEL_LAYOUTS[payload_type].bytes_per_pixel, image_format)
+    return image.rgbSwapped() if swap else image
+
+
+def _qimage_to_raw(image: QImage, payload_type) -> bytes:
+    (image_format, swap) = _QIMAGE_LAYOUTS[payload_type]
+    image = image.convertToFormat(image_format)
+    if swap:
+        image = image.rgbSwapped()
+    return image.constBits().asstring(image.byteCount())
+
+
+def _extract_message_image(payload):
     (payload_type, content) = payload
     if payload_type == PayloadType.PNG:
-        return QImage.fromData(content, None)
+        return QImage.fromData(bytes(content), None)
+    elif payload_type == PayloadType.RAW_RGBA:
+        image = QImage(bytes(content.data), content.width, content.height, content.stride, QImage.Format.Format_RGBA8888)
+        return image.convertToFormat(QImage.Format.Format_ARGB32)
+    elif payload_type == PayloadType.RAW_RGB:
+        image = QImage(bytes(content.data), content.width, content.height, content.stride, QImage.Format.Format_RGB888)
+        return image.convertToFormat(QImage.Format.Format_ARGB32)
+    elif payload_type == PayloadType.RAW_ARGB32:
+        image = QImage(bytes(content.data), content.width, content.height, content.stride, QImage.Format.Format_ARGB32)
+        return image.copy()
+    elif payload_type in _QIMAGE_LAYOUTS:
+        # Kept at full depth until the layer is created
+        (image_format, swap) = _QIMAGE_LAYOUTS[payload_type]
+        image = QImage(bytes(content.data), content.width, content.height, content.stride, image_format)
+        return image.rgbSwapped() if swap else image.copy()
+    elif payload_type in _FLOAT_PAYLOAD_TYPES:
+        # Shown as 8-bit, the float pixels go to the layer as they are
+        row_size = content.width * RAW_PIXEL_LAYOUTS[payload_type].bytes_per_pixel
+        pixel_data = bytes(content.data) if content.stride == row_size else _crop_pixels(content.data, content.stride, RAW_PIXEL_LAYOUTS[payload_type].bytes_per_pixel, 0, 0, content.width, content.height)
+        image = QImage(_float_to_argb32(pixel_data, payload_type), content.width, content.height, QImage.Format.Format_ARGB32)
+        return DeepImage(image.copy(), payload_type, pixel_data)
     else:
         return None
 
 
-def _flatten_tree(node):
-    result = [node]
-    child_nodes = node.childNodes()
-    child_nodes = sorted(child_nodes, key=lambda node: node.index(), reverse=True)
-    for child in child_nodes:
-        result.extend(_flatten_tree(child))
-    return result
+def _image_format_setting():
+    try:
+        return ImageFormat(read_setting("image_format", ImageFormat.AUTO.value))
+    except ValueError:
+        return ImageFormat.AUTO
+
+
+def _dirty_rects(old_pixels: bytes, new_pixels: bytes, width, height, bytes_per_pixel, tile_size):
+    """
+    Compares two projections and returns (x, y, width, height) rects covering the tiles that differ. Rows are
+    compared whole first, so only the few rows an edit touches are split into tiles. Dirty tiles next to each other in
+    a tile row are merged into one rect.
+    """
+    stride = width * bytes_per_pixel
+    rects = []
+    for tile_y in range(0, height, tile_size):
+        rows = [y for y in range(tile_y, min(tile_y + tile_size, height))
+                if old_pixels[y * stride:(y + 1) * stride] != new_pixels[y * stride:(y + 1) * stride]]
+        if len(rows) == 0:
+            continue
+        top, bottom = rows[0], rows[-1] + 1
+        run_start = None
+        for tile_x in range(0, width + tile_size, tile_size):
+            dirty = False
+            if tile_x < width:
+                start, end = tile_x * bytes_per_pixel, min(tile_x + tile_size, width) * bytes_per_pixel
+                dirty = any(old_pixels[y * stride + start:y * stride + end] != new_pixels[y * stride + start:y * stride + end] for y in rows)
+            if dirty and run_start is None:
+                run_start = tile_x
+            elif not dirty and run_start is not None:
+                rects.append((run_start, top, min(tile_x, width) - run_start, bottom - top))
+                run_start = None
+    return rects
+
+
+def _request_rect(document, json_payload):
+    """
+    Document area a GetImageKrita request asks for as (x, y, width, height), clipped to the canvas.
+    """
+    document_width, document_height = document.width(), document.height()
+    region = getattr(json_payload, "region", ImageRegion.DOCUMENT)
+    selection = document.selection() if region == ImageRegion.SELECTION else None
+    if selection is not None:
+        rect = (selection.x(), selection.y(), selection.width(), selection.height())
+    elif region == ImageRegion.RECT and len(json_payload.rect) == 4:
+        rect = tuple(json_payload.rect)
+    else:
+        return 0, 0, document_width, document_height
+
+    left, top = max(0, rect[0]), max(0, rect[1])
+    right, bottom = min(document_width, rect[0] + rect[2]), min(document_height, rect[1] + rect[3])
+    if right <= left or bottom <= top:
+        return 0, 0, document_width, document_height
+    return left, top, right - left, bottom - top
+
+
+def _requested_selection(document, json_payload):
+    mask_source = getattr(json_payload, "mask", MaskSource.ALPHA)
+    if mask_source == MaskSource.SELECTION:
+        return document.selection()
+    if mask_source == MaskSource.SELECTION_MASK:
+        node = document.nodeByName(json_payload.mask_layer)
+        if node is not None and node.type() == "selectionmask":
+            return node.selection()
+    return None
+
+
+def _crop_pixels(pixels: bytes, stride, bytes_per_pixel, x, y, width, height) -> bytes:
+    return b''.join(pixels[row * stride + x * bytes_per_pixel:row * stride + (x + width) * bytes_per_pixel] for row in range(y, y + height))
+
+
+@dataclass
+class IncomingImages:
+    """
+    Images of one SendImageKrita message, decoded on worker threads as their payloads arrive and added on the GUI
+    thread in message order, each as soon as the ones before it are in.
+    """
+    message: CksBinaryMessage
+    submitted: int = 0  # Payloads handed to workers
+    total: int | None = None  # Payload count, known once the whole message is in
+    added: int = 0
+    run_uuid: str | None = None  # Resolved when the first image is added
+    skipped: bool = False  # The document is not open
+
+    def __post_init__(self):
+        self.images = {}  # Index -> decoded QImage, or None when the payload could not be decoded
+
+
+class _DecodeImageTask(QRunnable):
+    def __init__(self, client: KritaClient, incoming: IncomingImages, index, payload):
+        super().__init__()
+        self._client = client
+        self._incoming = incoming
+        self._index = index
+        self._payload = payload
+
+    def run(self):
+        try:
+            image = _extract_message_image(self._payload)
+        except Exception as e:
+            _print_exception_trace(e)
+            image = None
+        # Queued to the GUI thread
+        self._client.image_decoded.emit(self._incoming, self._index, image)
+
+
+def _finish_snapshot(snapshot: LayerSnapshot):
+    """
+    Scales and converts a snapshot to what is sent and checksums it into its revision. Runs on a worker thread, where
+    QImage is as usable as on the GUI thread.
+    """
+    if snapshot.revision:
+        return
+    region_width, region_height = snapshot.width, snapshot.height
+    scale = snapshot.max_side > 0 and max(region_width, region_height) > snapshot.max_side
+    if scale or snapshot.send_payload_type != snapshot.payload_type:
+        image = _raw_to_qimage(snapshot.pixel_data, region_width, region_height, snapshot.payload_type)
+        if scale:
+            image = image.scaled(snapshot.max_side, snapshot.max_side, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+        snapshot.width, snapshot.height = image.width(), image.height()
+        snapshot.pixel_data = _qimage_to_raw(image, snapshot.send_payload_type)
+        snapshot.payload_type = snapshot.send_payload_type
+    checksum = zlib.crc32(snapshot.pixel_data)
+
+    if snapshot.mask is not None:
+        if (snapshot.width, snapshot.height) != (region_width, region_height):
+            mask_image = QImage(snapshot.mask, region_width, region_height, snapshot.mask_stride, QImage.Format.Format_Grayscale8)
+            mask_image = mask_image.scaled(snapshot.width, snapshot.height, Qt.AspectRatioMode.IgnoreAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            snapshot.mask, snapshot.mask_stride = mask_image.constBits().asstring(mask_image.byteCount()), mask_image.bytesPerLine()
+        checksum = zlib.crc32(snapshot.mask, checksum)
+
+    # Lets ComfyUI keep the layer cached and skip the transfer while it stays the same
+    snapshot.revision = f"{snapshot.width}x{snapshot.height}:{checksum:08x}"
+
+
+def _encode_layer_payloads(message: CksBinaryMessage, snapshot: LayerSnapshot, known_revision, base_pixels, image_format, high_bit_depth):
+    """
+    Adds the layer to a message, as the tiles that changed since base_pixels when that is less than half the
+    image. Only touches the snapshot, so it runs on a worker thread.
+    """
+    width, height, pixel_data = snapshot.width, snapshot.height, snapshot.pixel_data
+    payload_type = snapshot.payload_type
+    bytes_per_pixel = RAW_PIXEL_LAYOUTS[payload_type].bytes_per_pixel
+    rects = None
+    if base_pixels is not None:
+        rects = _dirty_rects(base_pixels, pixel_data, width, height, bytes_per_pixel, _DELTA_TILE_SIZE)
+    if payload_type in _FLOAT_PAYLOAD_TYPES and not high_bit_depth:
+        # Float layers reach peers without high bit depth as 8-bit, converted here rather than on the GUI thread
+        pixel_data = _float_to_argb32(pixel_data, payload_type)
+        payload_type = PayloadType.RAW_ARGB32
+        bytes_per_pixel = RAW_PIXEL_LAYOUTS[payload_type].bytes_per_pixel
+    stride = width * bytes_per_pixel
+    if rects is not None:
+        # Past half the canvas the full image is about as cheap and saves patching on the other end
+        if sum(rect_width * rect_height for (_, _, rect_width, rect_height) in rects) * 2 < width * height:
+            message.json_payload.base_revision = known_revision
+            # Tiles are always raw, compressed unless raw pixels were asked for
+            compression = PayloadCompression.NONE if image_format == ImageFormat.RAW else PayloadCompression.ZLIB
+            for (x, y, rect_width, rect_height) in rects:
+                tile_data = _crop_pixels(pixel_data, stride, bytes_per_pixel, x, y, rect_width, rect_height)
+                message.add_payload(payload_type, CksRawImage(rect_width, rect_height, rect_width * bytes_per_pixel, tile_data, x, y, compression))
+            _add_mask_payload(message, snapshot)
+            return
+
+    if image_format == ImageFormat.PNG and payload_type == PayloadType.RAW_ARGB32:
+        q_image = QImage(pixel_data, width, height, QImage.Format.Format_ARGB32)
+
+        buffer = QBuffer()
+        buffer.open(QIODevice.WriteOnly)
+        q_image.save(buffer, "PNG")
+        byte_array = buffer.data().data()
+
+        message.add_payload(PayloadType.PNG, byte_array)
+    else:
+        # projectionPixelData is already in the layout the payload type names
+        compression = PayloadCompression.NONE if image_format == ImageFormat.RAW else PayloadCompression.ZLIB
+        raw_image = CksRawImage(width, height, stride, pixel_data, compression=compression)
+        message.add_payload(payload_type, raw_image)
+    _add_mask_payload(message, snapshot)
+
+
+def _add_mask_payload(message: CksBinaryMessage, snapshot: LayerSnapshot):
+    if snapshot.mask is None:
+        return
+    # Selections are mostly runs of 0 and 255, which deflate shrinks to almost nothing
+    mask = CksRawImage(snapshot.width, snapshot.height, snapshot.mask_stride, snapshot.mask, compression=PayloadCompression.ZLIB)
+    message.add_payload(PayloadType.MASK_8, mask)
+
+
+class _EncodeMessageTask(QRunnable):
+    """
+    Fills a message on a worker thread and encodes it to websocket frames, compression included. Each frame goes to
+    the loop thread as soon as it is encoded, and the worker waits while it is _FRAMES_AHEAD frames ahead of the
+    sending, so a chunked message is never held encoded in full. The frames end with None, or an exception and None.
+    A fill returning False drops the message, and done is called once the message is encoded or dropped.
+    """
+    def __init__(self, fill, message: CksBinaryMessage, peer: CksPeerInfo, message_id, chunk_size, frames: queue.Queue, done=None):
+        super().__init__()
+        self._fill = fill
+        self._message = message
+        self._peer = peer
+        self._message_id = message_id
+        self._chunk_size = chunk_size
+        self._frames = frames
+        self._done = done
+
+    def run(self):
+        try:
+            if self._fill is None or self._fill():
+                if self._peer.supports(CAPABILITY_CHUNKED):
+                    for frame in self._message.encode_chunks(self._message_id, self._chunk_size):
+                        self._frames.put(frame)
+                else:
+                    self._frames.put(self._message.encode_message(self._peer.protocol_version))
+        except Exception as e:
+            self._frames.put(e)
+        finally:
+            if self._done is not None:
+                self._done()
+            self._frames.put(None)
 
 
 class KritaClient(QObject):
     websocket_updated = pyqtSignal(ConnectionState)
     websocket_message_received = pyqtSignal(CksBinaryMessage)
     image_added = pyqtSignal(str, str, list)
+    image_decoded = pyqtSignal(object, int, object)  # IncomingImages, index, QImage or None
     document_changed = pyqtSignal(str)
     delete_selected_image = pyqtSignal()
     delete_selected_run = pyqtSignal()
@@ -72,18 +429,43 @@ class KritaClient(QObject):
         self._loop_thread.start()
         self._id = str(uuid.uuid4())
         self._connection_state = ConnectionState.Disconnected
+        self._peer = CksPeerInfo()  # Version 1 until the server answers with a handshake
+        self._message_ids = itertools.count()
+        self._chunk_size = read_int_setting("chunk_size", DEFAULT_CHUNK_SIZE)
+        self._sent_layers = OrderedDict()  # View key -> (revision, width, height, pixel bytes)
+        self._sent_layers_size = 0
+        # Workers fill layer messages, this guards the sent layers and the revisions of subscriptions
+        self._sent_layers_lock = threading.Lock()
+        self._layer_indexes = {}  # DocumentId -> LayerIndex
+        self._sent_layers_limit = read_int_setting("delta_cache_mb", 512) * 1024 * 1024
+        self._subscriptions = {}  # (DocumentId, layer) -> LayerSubscription
+        self._subscription_timer = QTimer(self)
+        self._subscription_timer.timeout.connect(self._push_subscribed_layers)
+        # Opening or closing several documents at once sends one DocumentSync
+        self._document_sync_timer = QTimer(self)
+        self._document_sync_timer.setSingleShot(True)
+        self._document_sync_timer.setInterval(_DOCUMENT_SYNC_DELAY_MS)
+        self._document_sync_timer.timeout.connect(self._send_document_sync)
+        self._synced_documents = None  # DocumentId -> entry ComfyUI has, None until the first full sync
         self.connection_coroutine = None
         self.websocket_message_received.connect(self.websocket_message_received_handler)
+        # Decoding received images and encoding outgoing layers, so the GUI thread only handles QImages and pixels
+        self._worker_pool = QThreadPool(self)
+        self._encoded_queue = None  # Messages encoding on workers, in send order, created on the loop thread
+        self._incoming_images = {}  # id(CksBinaryMessage) -> IncomingImages, written by the loop thread
+        self.image_decoded.connect(self.image_decoded_handler)
 
         notifier = Krita.instance().notifier()
         notifier.setActive(True)
-        notifier.imageCreated.connect(self.documents_changed_handler)
-        notifier.imageClosed.connect(self.documents_changed_handler)
+        notifier.imageCreated.connect(self.image_created_handler)
+        notifier.imageClosed.connect(self.image_closed_handler)
         notifier.imageSaved.connect(self.documents_changed_handler)
+        # Open documents by id, kept current by the notifier so messages never scan every document
+        self._documents = {get_document_id(document): document for document in Krita.instance().documents()}
         self.websocket_updated.connect(self.websocket_updated_handler)
-        self.document_list = [] # Tuple(DocumentId, DocumentName)
+        self.document_list = [] # Tuple(DocumentId, DocumentName, ColorDepth)
         self.run_map = {}       # DocumentId -> {RunId, ImageIds}
-        self.image_map = {}     # ImageId -> QImage
+        self.image_map = ImageStore(read_int_setting("history_memory_mb", 1024) * 1024 * 1024, read_setting("history_cache_dir", ""), self)  # ImageId -> QImage
 
     _instance: KritaClient | None = None
 
@@ -100,6 +482,12 @@ class KritaClient(QObject):
         self.delete_selected_run.emit()
 
     def websocket_updated_handler(self, connected):
+        if connected != ConnectionState.Connected:
+            # ComfyUI forgets subscriptions and documents with the connection
+            self._clear_subscriptions()
+            self._synced_documents = None
+            # Messages cut off mid-way never complete, images already decoding still get added
+            self._incoming_images.clear()
         if connected:
             self.documents_changed_handler(None)
 
@@ -124,137 +512,329 @@ class KritaClient(QObject):
                         del self.image_map[image_id]
             del self.run_map[document_id]
 
-    def documents_changed_handler(self, _):
-        if self._websocket is not None:
-            documents = Krita.instance().documents()
-
-            # Get old document IDs from self.document_list
-            old_document_ids = [doc_id for doc_id, _ in self.document_list]
+    def image_created_handler(self, document):
+        self._documents[get_document_id(document)] = document
+        self.documents_changed_handler(None)
 
-            self.document_list = [(document.rootNode().uniqueId().toString()[1:-1], get_document_name(document)) for document in documents]
+    def image_closed_handler(self, _):
+        # The signal only carries a file name, but the closed document is already gone from the list
+        open_documents = {get_document_id(document): document for document in Krita.instance().documents()}
+        missing_document_ids = set(self._documents) - set(open_documents)
+        self._documents = open_documents
 
-            # Get new document IDs from self.document_list
-            new_document_ids = [doc_id for doc_id, _ in self.document_list]
-
-            # Get a list of any document IDs that are now missing from new_document_ids compared to old_document_ids
-            missing_document_ids = set(old_document_ids) - set(new_document_ids)
-
-            # Get all image IDs for those documents from self.run_map and delete the images in self.image_map, as well as the runs from self.run_map
-            for missing_doc_id in missing_document_ids:
-                self.clear_history_for_document_id(missing_doc_id)
+        # Get all image IDs for those documents from self.run_map and delete the images in self.image_map, as well as the runs from self.run_map
+        for missing_doc_id in missing_document_ids:
+            self.clear_history_for_document_id(missing_doc_id)
+            self._forget_sent_layers(missing_doc_id)
+            self._layer_indexes.pop(missing_doc_id, None)
+            self._clear_subscriptions(missing_doc_id)
+        self.documents_changed_handler(None)
 
-            message = CksBinaryMessage(DocumentSyncJsonPayload(self.document_list))
-            message_bytes = message.encode_message()
-            self.run(self._websocket.send(message_bytes))
+    def documents_changed_handler(self, _):
+        if self._websocket is not None:
+            self.document_list = [(doc_id, get_document_name(document), _transfer_depth(document)) for (doc_id, document) in self._documents.items()]
+            self._document_sync_timer.start()
+
+    def image_payload_received(self, message: CksBinaryMessage, payload_type, content):
+        """
+        Runs on the loop thread for every image payload as soon as it is complete, before the rest of its message.
+        """
+        if message.json_payload.type != MessageType.SendImageKrita:
+            return
+        incoming = self._incoming_images.get(id(message))
+        if incoming is None:
+            incoming = IncomingImages(message)
+            self._incoming_images[id(message)] = incoming
+        self._decode_in_background(incoming, (payload_type, content))
+
+    def _decode_in_background(self, incoming: IncomingImages, payload):
+        self._worker_pool.start(_DecodeImageTask(self, incoming, incoming.submitted, payload))
+        incoming.submitted += 1
+
+    def image_decoded_handler(self, incoming: IncomingImages, index, image):
+        incoming.images[index] = image
+        self._add_decoded_images(incoming)
+
+    def _add_decoded_images(self, incoming: IncomingImages):
+        send_image_krita_payload = cast(SendImageKritaJsonPayload, incoming.message.json_payload)
+        if incoming.run_uuid is None and not incoming.skipped and 0 in incoming.images:
+            if self.find_document(send_image_krita_payload.krita_document) is None:
+                print(f"Krita document {send_image_krita_payload.krita_document} not found, skipping.")
+                incoming.skipped = True
+            elif (send_image_krita_payload.add_to_previous_run
+                  and send_image_krita_payload.krita_document in self.run_map
+                  and len(self.run_map[send_image_krita_payload.krita_document]) > 0):
+                previous_run_uuid = next(reversed(self.run_map[send_image_krita_payload.krita_document]))
+                incoming.run_uuid = previous_run_uuid
+                send_image_krita_payload.run_uuid = previous_run_uuid
+            else:
+                incoming.run_uuid = send_image_krita_payload.run_uuid
+
+        images_metadata = []
+        while incoming.added in incoming.images:
+            image = incoming.images.pop(incoming.added)
+            incoming.added += 1
+            if incoming.skipped:
+                continue
+            if image is None:
+                print("Error extracting image from payload.")
+                continue
+            image_uuid = str(uuid.uuid4())
+
+            image_metadata = copy(send_image_krita_payload.__dict__)
+            image_metadata["image_uuid"] = image_uuid
+
+            self.image_map[image_uuid] = image
+            if send_image_krita_payload.krita_document not in self.run_map:
+                self.run_map[send_image_krita_payload.krita_document] = OrderedDict()
+            self.run_map[send_image_krita_payload.krita_document].setdefault(incoming.run_uuid, []).append(image_metadata)
+            images_metadata.append(image_metadata)
+        if len(images_metadata) > 0:
+            self.image_added.emit(send_image_krita_payload.krita_document, incoming.run_uuid, images_metadata)
+
+        if incoming.total is not None and incoming.added == incoming.total:
+            self._incoming_images.pop(id(incoming.message), None)
+
+    def _send_document_sync(self):
+        """
+        Tells ComfyUI which documents are open: the whole list after connecting, then only what was opened, renamed
+        or closed since, and nothing when saving changed nothing it shows.
+        """
+        if self._websocket is None:
+            return
+        documents = {item[0]: item for item in self.document_list}
+        if self._synced_documents is None or not self._peer.supports(CAPABILITY_DOCUMENT_DELTA):
+            json_payload = DocumentSyncJsonPayload(self.document_list)
+        else:
+            changed = [item for (document_id, item) in documents.items() if self._synced_documents.get(document_id) != item]
+            removed = [document_id for document_id in self._synced_documents if document_id not in documents]
+            if len(changed) == 0 and len(removed) == 0:
+                return
+            json_payload = DocumentSyncJsonPayload(changed, delta=True, removed=removed)
+        self._synced_documents = documents
+        self.run(self.send_message(CksBinaryMessage(json_payload)))
 
     def websocket_message_received_handler(self, decoded_message):
         json_payload = decoded_message.json_payload
 
         if json_payload.type == MessageType.SendImageKrita:
-            send_image_krita_payload = cast(SendImageKritaJsonPayload, json_payload)
+            # The images were handed to workers as they arrived, now their count is known
+            incoming = self._incoming_images.get(id(decoded_message))
+            if incoming is None:
+                if len(decoded_message.payloads) == 0:
+                    return
+                # Version 1 messages are decoded whole, so nothing was handed out yet
+                incoming = IncomingImages(decoded_message)
+                for payload in decoded_message.payloads:
+                    self._decode_in_background(incoming, payload)
+            incoming.total = incoming.submitted
+            self._add_decoded_images(incoming)
 
-            documents = Krita.instance().documents()
-            document_ids = [document.rootNode().uniqueId().toString()[1:-1] for document in documents]
+        elif json_payload.type == MessageType.GetImageKrita:
+            get_image_krita_payload = cast(GetImageKritaJsonPayload, json_payload)
+            message = CksBinaryMessage(json_payload)
+            fill = None
 
-            if send_image_krita_payload.krita_document not in document_ids:
-                print(f"Krita document {send_image_krita_payload.krita_document} not found, skipping.")
-                return
+            document = self.find_document(get_image_krita_payload.krita_document)
+            if document is not None:
+                target_layer_string = get_image_krita_payload.krita_layer
+                target_layer = self.find_target_layer(document, target_layer_string)
 
-            if (send_image_krita_payload.add_to_previous_run
-                and send_image_krita_payload.krita_document in self.run_map
-                and len(self.run_map[send_image_krita_payload.krita_document]) > 0):
-                previous_run_uuid = next(reversed(self.run_map[send_image_krita_payload.krita_document]))
-                run_uuid = previous_run_uuid
-                send_image_krita_payload.run_uuid = run_uuid
-            else:
-                run_uuid = send_image_krita_payload.run_uuid
-
-            images_metadata = []
-            for payload in decoded_message.payloads:
-                image = _extract_message_png_image(payload)
-                if image is None:
-                    raise Exception("Error extracting png image from payload.")
-                image_uuid = str(uuid.uuid4())
-
-                image_metadata = copy(send_image_krita_payload.__dict__)
-                image_metadata["image_uuid"] = image_uuid
-
-                self.image_map[image_uuid] = image
-                if send_image_krita_payload.krita_document in self.run_map:
-                    if run_uuid in self.run_map[send_image_krita_payload.krita_document]:
-                        self.run_map[send_image_krita_payload.krita_document][run_uuid].append(image_metadata)
-                    else:
-                        self.run_map[send_image_krita_payload.krita_document][run_uuid] = [image_metadata]
+                if target_layer is None:
+                    print(f"Krita layer {target_layer_string} not found.")
                 else:
-                    self.run_map[send_image_krita_payload.krita_document] = OrderedDict()
-                    self.run_map[send_image_krita_payload.krita_document][run_uuid] = [image_metadata]
-                images_metadata.append(image_metadata)
-            self.image_added.emit(send_image_krita_payload.krita_document, run_uuid, images_metadata)
+                    snapshot = self._layer_snapshot(document, target_layer, get_image_krita_payload)
+                    fill = self._layer_fill(message, snapshot, get_image_krita_payload.known_revision)
 
-        elif json_payload.type == MessageType.GetImageKrita:
-            get_image_krita_payload = cast(GetImageKritaJsonPayload, json_payload)
-            documents = Krita.instance().documents()
-
-            for document in documents:
-                document_uuid = document.rootNode().uniqueId().toString()[1:-1]
-
-                if get_image_krita_payload.krita_document == document_uuid:
-                    target_layer_string = get_image_krita_payload.krita_layer
-
-                    layer_names = target_layer_string.split("/")
-                    if len(layer_names) == 1:
-                        node_list = _flatten_tree(document.rootNode())
-                        node_list = [node for node in node_list if node.name() == layer_names[0] and node.type() in ["grouplayer", "paintlayer"]]
-                        if len(node_list) > 0:
-                            target_layer = node_list[0]
-                    else:
-                        current_node = document.rootNode()
-                        for i in range(len(layer_names) - 1):
-                            current_node = self.getOrCreateGroupNode(document, current_node, layer_names[i], create_if_missing=False)
-                        found_nodes = current_node.findChildNodes(layer_names[-1], False, False, "grouplayer", 0)
-                        if len(found_nodes) > 0:
-                            found_nodes = sorted(found_nodes, key=lambda node: node.index(), reverse=True)
-                            target_layer = found_nodes[0]
-                        else:
-                            found_nodes = current_node.findChildNodes(layer_names[-1], False, False, "paintlayer", 0)
-                            if len(found_nodes) > 0:
-                                found_nodes = sorted(found_nodes, key=lambda node: node.index(), reverse=True)
-                                target_layer = found_nodes[0]
-                            else:
-                                target_layer = current_node
-
-                    if target_layer is None:
-                        raise Exception(f"Krita layer {target_layer_string} not found.")
-
-                    pixel_data = target_layer.projectionPixelData(0, 0, document.width(), document.height())
-                    q_image = QImage(pixel_data, document.width(), document.height(), QImage.Format.Format_ARGB32)
-
-                    buffer = QBuffer()
-                    buffer.open(QIODevice.WriteOnly)
-                    q_image.save(buffer, "PNG")
-                    byte_array = buffer.data()
-
-                    message = CksBinaryMessage(json_payload)
-                    message.add_payload(PayloadType.PNG, byte_array)
-
-                    message_bytes = message.encode_message()
-
-                    self.run(self._websocket.send(message_bytes))
+            if fill is None and self._peer.protocol_version < 2:
+                # Version 1 servers read the first payload of every response and drop the connection without one
+                return
+            # A response without payloads tells ComfyUI the layer couldn't be found (unless marked unchanged), rather
+            # than letting it time out
+            self.send_in_background(message, fill)
+
+        elif json_payload.type == MessageType.LayerSubscription:
+            subscription_payload = cast(LayerSubscriptionJsonPayload, json_payload)
+            key = (subscription_payload.krita_document, subscription_payload.krita_layer)
+            if subscription_payload.active:
+                self._subscriptions[key] = LayerSubscription(subscription_payload.interval, subscription_payload.known_revision)
+            else:
+                self._subscriptions.pop(key, None)
+            self._update_subscription_timer()
+
+    def _layer_snapshot(self, document, target_layer, json_payload=None):
+        """
+        Reads the requested part of the layer and its selection. Only the reads happen here on the GUI thread,
+        scaling, conversion and the revision are left to _finish_snapshot on a worker.
+        """
+        (x, y, width, height) = _request_rect(document, json_payload)
+        pixel_data = target_layer.projectionPixelData(x, y, width, height).data()
+
+        # Deeper documents go out in their own layout when ComfyUI takes it, and as 8-bit otherwise
+        native_payload_type = _native_payload_type(document)
+        send_payload_type = native_payload_type
+        if send_payload_type != PayloadType.RAW_ARGB32 and (not self._peer.supports(CAPABILITY_HIGH_BIT_DEPTH) or self._peer.select_image_format(_image_format_setting()) == ImageFormat.PNG):
+            send_payload_type = PayloadType.RAW_ARGB32
+
+        max_side = getattr(json_payload, "max_side", 0)
+        if native_payload_type in _FLOAT_PAYLOAD_TYPES:
+            # No QImage holds floats, so the layer is sent at full size and made 8-bit on a worker if it has to be
+            send_payload_type, max_side = native_payload_type, 0
+
+        mask, mask_stride = None, 0
+        selection = _requested_selection(document, json_payload)
+        if selection is not None:
+            mask, mask_stride = selection.pixelData(x, y, width, height).data(), width
+        return LayerSnapshot(width, height, pixel_data, native_payload_type, mask, mask_stride, send_payload_type, max_side)
+
+    def _layer_fill(self, message: CksBinaryMessage, snapshot: LayerSnapshot, known_revision: str):
+        """
+        Returns the function that finishes the snapshot and fills a GetImageKrita response or LayerUpdate with it on a
+        worker thread. What it needs from the connection and settings is taken here, on the GUI thread.
+        """
+        peer = self._peer
+        image_format = peer.select_image_format(_image_format_setting())
+
+        def fill():
+            _finish_snapshot(snapshot)
+            self._add_layer_payloads(message, snapshot, known_revision, peer, image_format)
+            return True
+        return fill
+
+    def _subscription_fill(self, message: CksBinaryMessage, snapshot: LayerSnapshot, subscription: LayerSubscription):
+        """
+        Like _layer_fill for a LayerUpdate, but first checks on the worker whether the snapshot is pushed at all, and
+        drops the message if it isn't. A layer is pushed once its revision has held still for a whole interval, so a
+        stroke in progress doesn't send an update per tick.
+        """
+        peer = self._peer
+        image_format = peer.select_image_format(_image_format_setting())
+
+        def fill():
+            _finish_snapshot(snapshot)
+            with self._sent_layers_lock:
+                if not subscription.first_update:
+                    if snapshot.revision == subscription.pushed_revision or snapshot.revision != subscription.seen_revision:
+                        subscription.seen_revision = snapshot.revision
+                        return False
+                # The first update goes out right away, ComfyUI only trusts its copy once Krita has confirmed it
+                known_revision = subscription.pushed_revision
+                subscription.first_update = False
+                subscription.gone = False
+                subscription.seen_revision = snapshot.revision
+                subscription.pushed_revision = snapshot.revision
+            self._add_layer_payloads(message, snapshot, known_revision, peer, image_format)
+            return True
+        return fill
+
+    def _add_layer_payloads(self, message: CksBinaryMessage, snapshot: LayerSnapshot, known_revision: str, peer: CksPeerInfo, image_format):
+        """
+        Fills a GetImageKrita response or LayerUpdate on a worker thread: nothing if ComfyUI already has this revision,
+        only the changed tiles if it has the one sent last, the whole image otherwise.
+        """
+        json_payload = message.json_payload
+        json_payload.revision = snapshot.revision
+        sent_key = json_payload.view_key()
+        base_pixels = None
+        with self._sent_layers_lock:
+            subscription = self._subscriptions.get(sent_key)
+            if subscription is not None:
+                # Requests for a subscribed layer also change what ComfyUI has, the next update builds on this one
+                subscription.pushed_revision = snapshot.revision
+                subscription.gone = False
+            if known_revision == snapshot.revision:
+                json_payload.unchanged = True
+                return
 
-                    break
+            sent_layer = self._sent_layers.pop(sent_key, None)
+            if sent_layer is not None:
+                self._sent_layers_size -= len(sent_layer[3])
+            if peer.supports(CAPABILITY_TILE_DELTA):
+                self._remember_sent_layer(sent_key, snapshot.revision, snapshot.width, snapshot.height, snapshot.pixel_data)
+                if sent_layer is not None and sent_layer[:3] == (known_revision, snapshot.width, snapshot.height) and len(sent_layer[3]) == len(snapshot.pixel_data):
+                    base_pixels = sent_layer[3]
+
+        _encode_layer_payloads(message, snapshot, known_revision, base_pixels, image_format, peer.supports(CAPABILITY_HIGH_BIT_DEPTH))
+
+    def _update_subscription_timer(self):
+        if len(self._subscriptions) == 0:
+            self._subscription_timer.stop()
+            return
+        interval = min(subscription.interval for subscription in self._subscriptions.values())
+        self._subscription_timer.start(max(1, int(interval * 1000)))
+
+    def _clear_subscriptions(self, document_id=None):
+        for key in [key for key in self._subscriptions if document_id is None or key[0] == document_id]:
+            del self._subscriptions[key]
+        self._update_subscription_timer()
+
+    def _push_subscribed_layers(self):
+        """
+        Runs on the subscription timer and only reads the pixels of each subscribed layer, _subscription_fill decides
+        on a worker whether they are pushed. A layer whose last snapshot is still on a worker is left for a later tick.
+        """
+        for (document_id, layer), subscription in list(self._subscriptions.items()):
+            if subscription.encoding:
+                continue
+            document = self.find_document(document_id)
+            if document is None:
+                continue
+            target_layer = self.find_target_layer(document, layer)
+            if target_layer is None:
+                with self._sent_layers_lock:
+                    if subscription.gone:
+                        continue
+                    # An update without payloads drops the cached layer, so nodes ask for it again
+                    subscription.gone = True
+                    subscription.first_update = False
+                    subscription.pushed_revision = ""
+                self.send_in_background(CksBinaryMessage(LayerUpdateJsonPayload(document_id, layer)))
+                continue
+
+            subscription.encoding = True
+            message = CksBinaryMessage(LayerUpdateJsonPayload(document_id, layer))
+            snapshot = self._layer_snapshot(document, target_layer)
+            fill = self._subscription_fill(message, snapshot, subscription)
+            self.send_in_background(message, fill, done=lambda subscription=subscription: setattr(subscription, "encoding", False))
+
+    def find_document(self, document_id):
+        return self._documents.get(document_id)
+
+    def _remember_sent_layer(self, key, revision, width, height, pixel_data):
+        """
+        Keeps the last projection sent for each document/layer, so the next request can be answered with a delta.
+        """
+        self._sent_layers[key] = (revision, width, height, pixel_data)
+        self._sent_layers_size += len(pixel_data)
+        while self._sent_layers_size > self._sent_layers_limit and len(self._sent_layers) > 0:
+            (_, (_, _, _, evicted_data)) = self._sent_layers.popitem(last=False)
+            self._sent_layers_size -= len(evicted_data)
+
+    def _forget_sent_layers(self, document_id=None):
+        with self._sent_layers_lock:
+            for key in [key for key in self._sent_layers if document_id is None or key[0] == document_id]:
+                (_, _, _, pixel_data) = self._sent_layers.pop(key)
+                self._sent_layers_size -= len(pixel_data)
+
+    def layer_index(self, document) -> LayerIndex:
+        doc_id = get_document_id(document)
+        layer_index = self._layer_indexes.get(doc_id)
+        if layer_index is None:
+            layer_index = LayerIndex(document)
+            self._layer_indexes[doc_id] = layer_index
+        return layer_index
+
+    def find_target_layer(self, document, target_layer_string):
+        return self.layer_index(document).find_target_layer(target_layer_string)
 
     def getOrCreateGroupNode(self, doc: Krita.Document, parent_node, group_layer_name: str, create_if_missing: bool = True):
-        group_nodes = parent_node.findChildNodes(group_layer_name, False, False, "grouplayer", 0)
-
-        if len(group_nodes) == 0:
-            if create_if_missing:
-                group_node = doc.createNode(group_layer_name, "grouplayer")
-                parent_node.addChildNode(group_node, None)
-                return group_node
-            return None
-        else:
-            group_nodes = sorted(group_nodes, key=lambda node: node.index(), reverse=True)
-            return group_nodes[0]
+        group_node = self.layer_index(doc).find_group(parent_node, group_layer_name)
+
+        if group_node is None and create_if_missing:
+            group_node = doc.createNode(group_layer_name, "grouplayer")
+            parent_node.addChildNode(group_node, None)
+            self.layer_index(doc).invalidate()
+        return group_node
 
     def create(self, doc: Krita.Document, layer_name: str, img: QImage | None = None, preview: bool=False):
         if not img:
@@ -272,12 +852,23 @@ class KritaClient(QObject):
         if preview:
             node.setLocked(True)
 
-        converted_image = img.convertToFormat(QImage.Format.Format_ARGB32)
-
-        ptr = converted_image.constBits()
-        converted_image_bytes = QByteArray(ptr.asstring(converted_image.byteCount()))
-        node.setPixelData(converted_image_bytes, 0, 0, converted_image.width(), converted_image.height())
+        # setPixelData takes the layer's own layout, deeper images keep their precision
+        payload_type = _native_payload_type(doc)
+        convert_node = False
+        if isinstance(img, DeepImage) and img.payload_type == payload_type:
+            pixel_data = img.pixel_data
+        elif payload_type in _QIMAGE_LAYOUTS:
+            pixel_data = _qimage_to_raw(img, payload_type)
+        else:
+            # An image that isn't float for a float document, Krita converts the pixels once the layer is in
+            node.setColorSpace(doc.colorModel(), "U16", doc.colorProfile())
+            pixel_data = _qimage_to_raw(img, PayloadType.RAW_BGRA16)
+            convert_node = True
+        node.setPixelData(QByteArray(pixel_data), 0, 0, img.width(), img.height())
         new_layer_parent_node.addChildNode(node, None)
+        if convert_node:
+            node.setColorSpace(doc.colorModel(), doc.colorDepth(), doc.colorProfile())
+        self.layer_index(doc).invalidate()
 
     def remove(self, doc: Krita.Document, layer_name: str):
         layer_names = layer_name.split("/")
@@ -285,18 +876,18 @@ class KritaClient(QObject):
             preview_node = doc.nodeByName(layer_name)
             if preview_node is not None:
                 preview_node.remove()
+                self.layer_index(doc).invalidate()
         else:
             current_node = doc.rootNode()
             for i in range(len(layer_names) - 1):
-                found_nodes = current_node.findChildNodes(layer_names[i], False, False, "grouplayer", 0)
-                if len(found_nodes) > 0:
-                    current_node = found_nodes[0]
-                else:
+                current_node = self.getOrCreateGroupNode(doc, current_node, layer_names[i], create_if_missing=False)
+                if current_node is None:
                     print(f"Couldn't find layer {layer_names[i]} while searching for path {layer_name}")
                     return
             found_nodes = current_node.findChildNodes(layer_names[-1], False, False, "paintlayer", 0)
             if len(found_nodes) > 0:
                 found_nodes[0].remove()
+                self.layer_index(doc).invalidate()
             else:
                 print(f"Couldn't find layer {layer_names[-1]} while searching for path {layer_name}")
 
@@ -307,17 +898,24 @@ class KritaClient(QObject):
             self.websocket_updated.emit(self._connection_state)
 
             async for self._websocket in ws_client.connect(
-                uri=f"{url}/krita-sync-ws?clientId={self._id}&clientType=krita",
+                uri=f"{url}/krita-sync-ws?clientId={self._id}&clientType=krita&{CksPeerInfo.own().query_string()}",
                 # logger=logging.getLogger(), if we need to add a logger
                 max_size=2 ** 30,
                 read_limit=2 ** 30
             ):
                 try:
+                    self._peer = CksPeerInfo(local=is_local_address(urlparse(url).hostname))
                     self._connection_state = ConnectionState.Connected
                     self.websocket_updated.emit(self._connection_state)
+                    assembler = CksMessageAssembler(self.image_payload_received)
                     async for message in self._websocket:
-                        decoded_message = CksBinaryMessage.decode_message(message)
-                        self.websocket_message_received.emit(decoded_message)
+                        for decoded_message in assembler.feed(message):
+                            if decoded_message.json_payload.type == MessageType.Handshake:
+                                handshake_payload = cast(HandshakeJsonPayload, decoded_message.json_payload)
+                                self._peer = CksPeerInfo.negotiate(handshake_payload.protocol_version, handshake_payload.capabilities)
+                                self._peer.local = is_local_address(urlparse(url).hostname)
+                                continue
+                            self.websocket_message_received.emit(decoded_message)
                 except Exception as e:
                     _print_exception_trace(e)
                     print("Exception while processing ws messages, waiting 5 seconds before attempting to reconnect")
@@ -336,6 +934,56 @@ class KritaClient(QObject):
         self._connection_state = ConnectionState.Disconnected
         self.websocket_updated.emit(self._connection_state)
 
+    async def send_message(self, message: CksBinaryMessage):
+        websocket = self._websocket
+        if websocket is None:
+            return
+        if self._peer.supports(CAPABILITY_CHUNKED):
+            for chunk in message.encode_chunks(next(self._message_ids) & 0xFFFFFFFF, self._chunk_size):
+                await websocket.send(chunk)
+        else:
+            await websocket.send(message.encode_message(self._peer.protocol_version))
+
+    def send_in_background(self, message: CksBinaryMessage, fill=None, done=None):
+        """
+        Runs fill, which adds the message's payloads, and the encoding on a worker thread, so the GUI thread only
+        ever reads the pixels. Several messages encode at once and go out in the order they were queued, each frame
+        as soon as it is encoded. done is called on the worker once the message is encoded or dropped.
+        """
+        frames = queue.Queue(_FRAMES_AHEAD)
+        self._worker_pool.start(_EncodeMessageTask(fill, message, self._peer, next(self._message_ids) & 0xFFFFFFFF, self._chunk_size, frames, done))
+        self._loop.call_soon_threadsafe(self._queue_encoded, frames)
+
+    def _queue_encoded(self, frames: queue.Queue):
+        if self._encoded_queue is None:
+            self._encoded_queue = asyncio.Queue()
+            self._loop.create_task(self._send_encoded())
+        self._encoded_queue.put_nowait(frames)
+
+    async def _send_encoded(self):
+        while True:
+            frames = await self._encoded_queue.get()
+            websocket, failed = None, False
+            while True:
+                frame = await self._loop.run_in_executor(None, frames.get)
+                if frame is None:
+                    break
+                if failed:
+                    # Taken anyway, the worker only finishes once its last frame is
+                    continue
+                try:
+                    if isinstance(frame, Exception):
+                        raise frame
+                    if websocket is None:
+                        websocket = self._websocket
+                    if websocket is None:
+                        failed = True
+                        continue
+                    await websocket.send(frame)
+                except Exception as e:
+                    failed = True
+                    _print_exception_trace(e)
+
     async def disconnect(self):
         if self._websocket is not None:
             await self._websocket.close()
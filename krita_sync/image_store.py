@@ -0,0 +1,178 @@
+from __future__ import annotations
+
+import atexit
+import os
+import shutil
+import struct
+import tempfile
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PyQt5.QtCore import Qt, pyqtSignal, QObject
+from PyQt5.QtGui import QImage
+
+# Width, height, bytes per line and QImage.Format of a spilled image, payload type and deflated size of its deep
+# pixels (0 and 0 without), followed by its deflated pixels and then the deep ones
+_SPILL_HEADER = struct.Struct("<IIIIIQ")
+
+
+class DeepImage(QImage):
+    """
+    8-bit rendition of an image deeper than QImage can hold, shown in the history, carrying the pixels it was made
+    from so layers created from it get them unchanged.
+    """
+    def __init__(self, image: QImage, payload_type: int, pixel_data: bytes):
+        super().__init__(image)
+        self.payload_type = payload_type
+        self.pixel_data = pixel_data  # Laid out as payload_type, rows packed without padding
+
+
+def _image_bytes(image: QImage) -> int:
+    return image.byteCount() + (len(image.pixel_data) if isinstance(image, DeepImage) else 0)
+
+
+def _write_spill(path, image: QImage) -> int:
+    pixels = zlib.compress(image.constBits().asstring(image.byteCount()), 1)
+    (payload_type, deep_pixels) = (image.payload_type, zlib.compress(image.pixel_data, 1)) if isinstance(image, DeepImage) else (0, b"")
+    with open(path + ".part", "wb") as f:
+        f.write(_SPILL_HEADER.pack(image.width(), image.height(), image.bytesPerLine(), int(image.format()), payload_type, len(deep_pixels)))
+        f.write(pixels)
+        f.write(deep_pixels)
+    os.replace(path + ".part", path)
+    return _SPILL_HEADER.size + len(pixels) + len(deep_pixels)
+
+
+def _read_spill(path) -> QImage:
+    with open(path, "rb") as f:
+        data = f.read()
+    (width, height, bytes_per_line, image_format, payload_type, deep_size) = _SPILL_HEADER.unpack_from(data, 0)
+    pixels_end = len(data) - deep_size
+    pixels = zlib.decompress(memoryview(data)[_SPILL_HEADER.size:pixels_end])
+    # copy() detaches the image from pixels, which would otherwise have to outlive it
+    image = QImage(pixels, width, height, bytes_per_line, QImage.Format(image_format)).copy()
+    if deep_size > 0:
+        image = DeepImage(image, payload_type, zlib.decompress(memoryview(data)[pixels_end:]))
+    return image
+
+
+class ImageStore(QObject):
+    """
+    Full resolution images received from ComfyUI, by image id. Past max_bytes the least recently used ones are
+    deflated to a folder for this session under cache_dir (the system temp folder by default) on a background thread and read back when they are previewed or applied again. Pixels are
+    stored as they are, deep ones included, so spilling never costs precision. Thumbnails are small and always stay in memory.
+
+    Used like a dict from the GUI thread.
+    """
+    changed = pyqtSignal()
+    _spill_finished = pyqtSignal(str, object)  # Image id, spilled bytes or the exception
+
+    def __init__(self, max_bytes: int, cache_dir: str = "", parent=None):
+        super().__init__(parent)
+        self.max_bytes = max_bytes
+        self._cache_dir = tempfile.mkdtemp(prefix="cks_history_", dir=cache_dir or None)
+        atexit.register(shutil.rmtree, self._cache_dir, True)
+        self._resident: OrderedDict[str, QImage] = OrderedDict()
+        self._spilling = {}  # Image id -> QImage still in memory while it is written
+        self._spilled = {}  # Image id -> bytes on disk
+        self._discarded = set()  # Image ids discarded while they were being written
+        self._thumbnails = {}  # Image id -> (size, QImage)
+        self.resident_bytes = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="cks_spill")
+        self._spill_finished.connect(self._finish_spill)
+
+    def __contains__(self, image_id) -> bool:
+        return image_id in self._resident or image_id in self._spilling or image_id in self._spilled
+
+    def __setitem__(self, image_id, image: QImage):
+        self.discard(image_id)
+        self._resident[image_id] = image
+        self.resident_bytes += _image_bytes(image)
+        self._evict()
+        self.changed.emit()
+
+    def __getitem__(self, image_id) -> QImage:
+        image = self._resident.get(image_id)
+        if image is not None:
+            self._resident.move_to_end(image_id)
+            return image
+        image = self._spilling.get(image_id)
+        if image is not None:
+            return image
+        if image_id not in self._spilled:
+            raise KeyError(image_id)
+
+        image = _read_spill(self._path(image_id))
+        # The file stays, so evicting this image again costs nothing
+        self._resident[image_id] = image
+        self.resident_bytes += _image_bytes(image)
+        self._evict(keep=image_id)
+        self.changed.emit()
+        return image
+
+    def __delitem__(self, image_id):
+        if image_id not in self:
+            raise KeyError(image_id)
+        self.discard(image_id)
+
+    def discard(self, image_id):
+        if image_id not in self:
+            return
+        image = self._resident.pop(image_id, None)
+        if image is not None:
+            self.resident_bytes -= _image_bytes(image)
+        self._thumbnails.pop(image_id, None)
+        if self._spilling.pop(image_id, None) is not None:
+            # The file is removed once the write finishes
+            self._discarded.add(image_id)
+        if self._spilled.pop(image_id, None) is not None:
+            self._remove_file(image_id)
+        self.changed.emit()
+
+    def thumbnail(self, image_id, size) -> QImage:
+        (thumbnail_size, thumbnail) = self._thumbnails.get(image_id, (None, None))
+        if thumbnail_size != size:
+            thumbnail = self[image_id].scaled(size, size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            self._thumbnails[image_id] = (size, thumbnail)
+        return thumbnail
+
+    @property
+    def spilled_bytes(self) -> int:
+        return sum(self._spilled.values())
+
+    def _evict(self, keep=None):
+        while self.resident_bytes > self.max_bytes and len(self._resident) > 0:
+            image_id = next(iter(self._resident))
+            if image_id == keep:
+                break
+            image = self._resident.pop(image_id)
+            self.resident_bytes -= _image_bytes(image)
+            if image_id in self._spilled:
+                continue
+            self._spilling[image_id] = image
+            future = self._executor.submit(_write_spill, self._path(image_id), image)
+            future.add_done_callback(lambda f, spilled_id=image_id: self._spill_finished.emit(spilled_id, f.exception() or f.result()))
+
+    def _finish_spill(self, image_id, result):
+        if image_id in self._discarded:
+            self._discarded.discard(image_id)
+            self._remove_file(image_id)
+            return
+        image = self._spilling.pop(image_id)
+        if isinstance(result, Exception):
+            # Over budget beats losing the image
+            print(f"Couldn't write history image {image_id} to {self._cache_dir}, keeping it in memory: {result}")
+            self._resident[image_id] = image
+            self.resident_bytes += _image_bytes(image)
+        else:
+            self._spilled[image_id] = result
+        self.changed.emit()
+
+    def _path(self, image_id):
+        return os.path.join(self._cache_dir, f"{image_id}.qimage.z")
+
+    def _remove_file(self, image_id):
+        try:
+            os.remove(self._path(image_id))
+        except OSError:
+            pass
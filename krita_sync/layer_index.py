@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+LAYER_TYPES = ("grouplayer", "paintlayer")
+
+
+def _node_id(node) -> str:
+    return node.uniqueId().toString()
+
+
+class LayerIndex:
+    """
+    Layers of one document by name and by group path, built with one walk of the tree the first time a layer is
+    looked up. Lookups are dictionary hits per path segment, and the node found is checked against the document by
+    walking its parents, so layers deleted, renamed or moved since the walk are caught and the index rebuilt.
+
+    Krita has no signal for layers being added, so a layer added with the name of one that is already indexed is only
+    seen once the index is rebuilt: by a failed check, by invalidate(), or by a lookup that misses.
+    """
+    def __init__(self, document):
+        self._document = document
+        self._built = False
+        self._root = None
+        self._by_name = {}  # Name -> first layer with it, topmost first and parents before their children
+        self._children = {}  # Group id -> {(name, type) -> topmost child layer}
+
+    def invalidate(self):
+        self._built = False
+        self._root = None
+        self._by_name = {}
+        self._children = {}
+
+    def find_target_layer(self, target_layer_string):
+        """
+        Same resolution as a walk of the whole tree: a plain name is the first matching group or paint layer from the
+        top, a path goes through the topmost matching groups and ends at a group or else a paint layer. When only the
+        last part of a path is missing, its parent group is returned.
+        """
+        layer_names = target_layer_string.split("/")
+        node, complete = self._lookup(layer_names)
+        if complete and self._is_current(node, layer_names):
+            return node
+        # Missing or stale, walk the tree again
+        self._build()
+        return self._lookup(layer_names)[0]
+
+    def find_group(self, parent_node, group_name):
+        """
+        Topmost group named group_name directly under parent_node, or None.
+        """
+        self._ensure_built()
+        node = self._children.get(_node_id(parent_node), {}).get((group_name, "grouplayer"))
+        if node is not None and node.name() == group_name and node.parentNode() is not None and _node_id(node.parentNode()) == _node_id(parent_node):
+            return node
+        self._build()
+        return self._children.get(_node_id(parent_node), {}).get((group_name, "grouplayer"))
+
+    def _lookup(self, layer_names):
+        """
+        Returns the node for a path from the current index, and whether every part of the path was found.
+        """
+        self._ensure_built()
+        if len(layer_names) == 1:
+            node = self._by_name.get(layer_names[0])
+            return node, node is not None
+
+        current_node = self._root
+        for name in layer_names[:-1]:
+            current_node = self._children.get(_node_id(current_node), {}).get((name, "grouplayer"))
+            if current_node is None:
+                return None, False
+        children = self._children.get(_node_id(current_node), {})
+        for layer_type in LAYER_TYPES:
+            node = children.get((layer_names[-1], layer_type))
+            if node is not None:
+                return node, True
+        return current_node, False
+
+    def _is_current(self, node, layer_names) -> bool:
+        """
+        Whether node still has the path it was indexed under, checked along its parents only.
+        """
+        if node.name() != layer_names[-1]:
+            return False
+        parent = node.parentNode()
+        for name in reversed(layer_names[:-1]):
+            if parent is None or parent.name() != name:
+                return False
+            parent = parent.parentNode()
+        if len(layer_names) == 1:
+            # Any depth, as long as the layer is still in the document
+            while parent is not None and parent.parentNode() is not None:
+                parent = parent.parentNode()
+        elif parent is not None and parent.parentNode() is not None:
+            return False
+        return parent is not None and _node_id(parent) == _node_id(self._root)
+
+    def _ensure_built(self):
+        if not self._built:
+            self._build()
+
+    def _build(self):
+        self.invalidate()
+        self._root = self._document.rootNode()
+        stack = [self._root]
+        while len(stack) > 0:
+            node = stack.pop()
+            name, layer_type = node.name(), node.type()
+            if layer_type in LAYER_TYPES:
+                self._by_name.setdefault(name, node)
+
+            child_nodes = sorted(node.childNodes(), key=lambda child: child.index(), reverse=True)
+            if len(child_nodes) > 0:
+                children = self._children.setdefault(_node_id(node), {})
+                for child in child_nodes:
+                    child_type = child.type()
+                    if child_type in LAYER_TYPES:
+                        children.setdefault((child.name(), child_type), child)
+                # Topmost child is visited first
+                stack.extend(reversed(child_nodes))
+        self._built = True
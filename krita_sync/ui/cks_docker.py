@@ -59,6 +59,11 @@ class ComfyKritaSyncDocker(DockWidget):
         self.button_clear_all.clicked.connect(self.clear_all)
         document_widget.layout().addWidget(self.button_clear_all)
 
+        # Memory used by received images, in RAM and spilled to disk
+        self.label_history_memory = QLabel()
+        self.label_history_memory.setContentsMargins(11, 0, 11, 0)
+        main_widget.layout().addWidget(self.label_history_memory)
+
         # History Widget
         scroll_area = QScrollArea()
         scroll_area.setWidgetResizable(True)
@@ -71,6 +76,8 @@ class ComfyKritaSyncDocker(DockWidget):
         client = KritaClient.instance()
         client.websocket_updated.connect(self.websocket_updated)
         self.websocket_updated(client.get_connection_state())
+        client.image_map.changed.connect(self.history_memory_changed)
+        self.history_memory_changed()
 
     def canvasChanged(self, canvas):
         if canvas is not None and canvas.view() is not None:
@@ -107,6 +114,10 @@ class ComfyKritaSyncDocker(DockWidget):
         client.clear_history_for_document_id(document_uuid)
         self.history_widget.document_changed_handler(document_uuid)
 
+    def history_memory_changed(self):
+        image_map = KritaClient.instance().image_map
+        self.label_history_memory.setText(f"History: {image_map.resident_bytes / 2 ** 20:.0f} MB in memory, {image_map.spilled_bytes / 2 ** 20:.0f} MB on disk")
+
     def websocket_updated(self, state):
         if state == ConnectionState.Disconnected:
             self.label_status.setText("D")
@@ -54,8 +54,8 @@ class GenHistoryWidget(QFrame):
             self.list_widgets[run_uuid] = list_widget
 
         for image_metadata in images_metadata:
-            image = KritaClient.instance().image_map[image_metadata["image_uuid"]]
-            scaled_image = image.scaled(self.thumb_size, self.thumb_size, Qt.AspectRatioMode.KeepAspectRatio, Qt.TransformationMode.SmoothTransformation)
+            # Kept in memory by the image store, so redrawing a run never reloads spilled images
+            scaled_image = KritaClient.instance().image_map.thumbnail(image_metadata["image_uuid"], self.thumb_size)
 
             thumb_pixmap = QPixmap(self.thumb_size, self.thumb_size)
             thumb_pixmap.fill(QColor(0, 0, 0, 0))
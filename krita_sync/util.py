@@ -2,6 +2,18 @@ import os
 
 from krita import Krita  # type: ignore
 
+
+def read_setting(key, default):
+    return Krita.instance().readSetting("ComfyKritaSync", key, str(default))
+
+
+def read_int_setting(key, default):
+    try:
+        return int(read_setting(key, default))
+    except ValueError:
+        return default
+
+
 def docker_document(source_docker, require_active_window=False):
     windows = Krita.instance().windows()
     selected_window = None
@@ -15,8 +27,11 @@ def docker_document(source_docker, require_active_window=False):
     if selected_window is None or selected_window.activeView() is None or selected_window.activeView().document() is None:
         return None, None
     document = selected_window.activeView().document()
-    document_uuid = document.rootNode().uniqueId().toString()[1:-1]
-    return document, document_uuid
+    return document, get_document_id(document)
+
+
+def get_document_id(document):
+    return document.rootNode().uniqueId().toString()[1:-1]
 
 
 def get_document_name(document):
@@ -0,0 +1,103 @@
+"""
+Encode and decode timings for the CKS framing, run with python tests/benchmark_cks_binary_message.py.
+
+Compares the version 1 (base64) and version 2 (binary) framing on PNG sized payloads, and shows the stream decoder's
+cost per payload and per MB staying flat as messages grow. Ends with the scaling checks, which fail if a decoder
+goes back to copying the rest of the buffer per payload or copying whole payloads.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from krita_sync.cks_common.CksBinaryMessage import CksBinaryMessage, CksStreamDecoder, CksMessageAssembler, SendImageKritaJsonPayload, PayloadType  # noqa: E402
+
+
+def best_time(function, repeats=5):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def png_message(payload_count, payload_size):
+    message = CksBinaryMessage(SendImageKritaJsonPayload("document", "layer", "run", False))
+    # Compressed image data doesn't compress further, random bytes stand in for it
+    payload = os.urandom(payload_size)
+    for _ in range(payload_count):
+        message.add_payload(PayloadType.PNG, payload)
+    return message
+
+
+def framing_versions():
+    print("Framing, batch of 4 PNG payloads")
+    print(f"{'payload':>10} {'version':>8} {'wire MB':>9} {'encode ms':>10} {'decode ms':>10}")
+    for payload_mb in (1, 8, 24):
+        message = png_message(4, payload_mb << 20)
+        for protocol_version in (1, 2):
+            data = message.encode_message(protocol_version)
+            encode = best_time(lambda: message.encode_message(protocol_version))
+            decode = best_time(lambda: CksBinaryMessage.decode_message(data))
+            print(f"{payload_mb:>8}MB {protocol_version:>8} {len(data) / (1 << 20):>9.1f} {encode * 1000:>10.2f} {decode * 1000:>10.2f}")
+
+
+def payload_count_scaling():
+    print("Stream decoder, 4 KB payloads")
+    print(f"{'payloads':>10} {'decode ms':>10} {'us/payload':>11}")
+    for payload_count in (1000, 2000, 4000, 8000, 16000):
+        data = png_message(payload_count, 4096).encode_message()
+        decode = best_time(lambda: CksStreamDecoder().feed(data))
+        print(f"{payload_count:>10} {decode * 1000:>10.2f} {decode * 1e6 / payload_count:>11.2f}")
+
+
+def assemble(chunks):
+    assembler = CksMessageAssembler()
+    for chunk in chunks:
+        assembler.feed(chunk)
+
+
+def payload_size_scaling():
+    print("Assembler, 8 payloads in 1 MB chunks")
+    print(f"{'payload':>10} {'decode ms':>10} {'ms/MB':>8}")
+    for payload_mb in (1, 4, 16, 64):
+        chunks = list(png_message(8, payload_mb << 20).encode_chunks(0))
+        decode = best_time(lambda: assemble(chunks), repeats=3)
+        print(f"{payload_mb:>8}MB {decode * 1000:>10.2f} {decode * 1000 / (8 * payload_mb):>8.3f}")
+
+
+def whole_payload_sizes():
+    print("Stream decoder, 50 payloads fed in one piece")
+    print(f"{'payload':>10} {'decode ms':>10}")
+    for payload_kb in (16, 256, 1024):
+        data = png_message(50, payload_kb << 10).encode_message()
+        decode = best_time(lambda: CksStreamDecoder().feed(data))
+        print(f"{payload_kb:>8}KB {decode * 1000:>10.3f}")
+
+
+def scaling_checks():
+    def decode_time(payload_count, payload_size):
+        data = png_message(payload_count, payload_size).encode_message()
+        return best_time(lambda: CksStreamDecoder().feed(data))
+
+    # The old decoder copied the rest of the buffer for every payload, 8x the payloads took about 64x as long
+    count_ratio = decode_time(4000, 4096) / decode_time(500, 4096)
+    # Whole payloads are views, so their size costs nothing
+    size_ratio = decode_time(50, 1 << 20) / decode_time(50, 1 << 14)
+    print(f"8x the payloads: {count_ratio:.1f}x the time, 64x larger payloads: {size_ratio:.1f}x the time")
+    assert count_ratio < 8 * 3, "decode time grows faster than the payload count"
+    assert size_ratio < 3, "decode time grows with the payload size"
+
+
+if __name__ == "__main__":
+    framing_versions()
+    print()
+    payload_count_scaling()
+    print()
+    payload_size_scaling()
+    print()
+    whole_payload_sizes()
+    print()
+    scaling_checks()
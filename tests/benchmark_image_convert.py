@@ -0,0 +1,61 @@
+"""
+Timings for turning a SendImageKrita IMAGE batch into 8-bit images, run with python tests/benchmark_image_convert.py.
+
+Compares images_to_uint8, which converts the whole batch into one uint8 buffer, with the per image float copy, clip
+and cast it replaced. Both end with a PIL image per batch entry, as the preview needs. Needs torch, numpy and Pillow,
+and runs on the GPU as well when there is one.
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from comfy_sync.image_convert import images_to_uint8  # noqa: E402
+
+
+def best_time(function, repeats=5):
+    best = float("inf")
+    for _ in range(repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def per_image(images):
+    # The conversion SendImageKrita did before images_to_uint8
+    result_images = []
+    for tensor in images:
+        array = 255.0 * tensor.cpu().numpy()
+        result_images.append(Image.fromarray(np.clip(array, 0, 255).astype(np.uint8)))
+    return result_images
+
+
+def whole_batch(images):
+    return [Image.fromarray(pixels) for pixels in images_to_uint8(images)]
+
+
+def conversion(device):
+    print(f"IMAGE batch to 8-bit PIL images, {device}")
+    print(f"{'size':>6} {'batch':>6} {'per image ms':>13} {'whole batch ms':>15} {'speedup':>8}")
+    for (size, batch_size) in ((512, 1), (512, 16), (1024, 1), (1024, 8), (2048, 1), (2048, 4)):
+        # Values past 0..1 exercise the clamp, as models can produce them
+        images = torch.rand((batch_size, size, size, 3), device=device).mul_(1.2).sub_(0.1)
+        assert all(np.array_equal(np.asarray(old), np.asarray(new)) for old, new in zip(per_image(images), whole_batch(images)))
+        old = best_time(lambda: per_image(images))
+        new = best_time(lambda: whole_batch(images))
+        print(f"{size:>6} {batch_size:>6} {old * 1000:>13.1f} {new * 1000:>15.1f} {old / new:>7.1f}x")
+
+
+if __name__ == "__main__":
+    conversion("cpu")
+    if torch.cuda.is_available():
+        print()
+        conversion("cuda")
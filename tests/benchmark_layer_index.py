@@ -0,0 +1,93 @@
+"""
+Layer lookup timings on synthetic layer trees, run with python tests/benchmark_layer_index.py.
+
+Compares LayerIndex with the walk of the whole tree it replaced, for a bare layer name and for a group path to the
+deepest layer. Nodes are stand-ins with the same calls as krita.Node and no cost of their own, so in Krita, where
+every call crosses into C++, both columns are slower but the full walk grows with the tree the same way.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from krita_sync.layer_index import LayerIndex  # noqa: E402
+from krita_stubs import StubDocument, group, paint  # noqa: E402
+
+
+def best_time(function, repeats=5, number=20):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def _flatten_tree(node):
+    result = [node]
+    for child in sorted(node.childNodes(), key=lambda child: child.index(), reverse=True):
+        result.extend(_flatten_tree(child))
+    return result
+
+
+def walk_find_target_layer(document, target_layer_string):
+    # The lookup find_target_layer did before LayerIndex
+    layer_names = target_layer_string.split("/")
+    if len(layer_names) == 1:
+        node_list = [node for node in _flatten_tree(document.rootNode()) if node.name() == layer_names[0] and node.type() in ["grouplayer", "paintlayer"]]
+        return node_list[0] if len(node_list) > 0 else None
+
+    current_node = document.rootNode()
+    for name in layer_names[:-1]:
+        group_nodes = current_node.findChildNodes(name, False, False, "grouplayer", 0)
+        if len(group_nodes) == 0:
+            return None
+        current_node = sorted(group_nodes, key=lambda node: node.index(), reverse=True)[0]
+    for layer_type in ("grouplayer", "paintlayer"):
+        found_nodes = current_node.findChildNodes(layer_names[-1], False, False, layer_type, 0)
+        if len(found_nodes) > 0:
+            return sorted(found_nodes, key=lambda node: node.index(), reverse=True)[0]
+    return current_node
+
+
+def deep_document(depth, layers_per_group):
+    """
+    A chain of depth nested groups, each also holding layers_per_group paint layers. The one layer named "Target"
+    is at the bottom of the deepest group, so a preorder walk visits everything before it.
+    """
+    node = group(f"Group {depth}", paint("Target"), *(paint(f"Layer {depth}.{i}") for i in range(layers_per_group)))
+    for level in range(depth - 1, 0, -1):
+        node = group(f"Group {level}", node, *(paint(f"Layer {level}.{i}") for i in range(layers_per_group)))
+    return StubDocument(node)
+
+
+def lookups():
+    print("Layer lookup, target at the bottom of the deepest group")
+    print(f"{'depth':>6} {'layers':>7} {'lookup':>7} {'full walk us':>13} {'index us':>9} {'speedup':>8}")
+    for (depth, layers_per_group) in ((5, 10), (10, 30), (20, 30), (40, 50)):
+        document = deep_document(depth, layers_per_group)
+        layer_index = LayerIndex(document)
+        path = "/".join(f"Group {level}" for level in range(1, depth + 1)) + "/Target"
+        for (lookup, target) in (("name", "Target"), ("path", path)):
+            assert walk_find_target_layer(document, target) is layer_index.find_target_layer(target)
+            walk = best_time(lambda: walk_find_target_layer(document, target))
+            indexed = best_time(lambda: layer_index.find_target_layer(target))
+            print(f"{depth:>6} {depth * (layers_per_group + 1):>7} {lookup:>7} {walk * 1e6:>13.1f} {indexed * 1e6:>9.1f} {walk / indexed:>7.0f}x")
+
+
+def first_lookup():
+    print("First lookup, which builds the index")
+    print(f"{'depth':>6} {'layers':>7} {'full walk us':>13} {'build us':>9}")
+    for (depth, layers_per_group) in ((10, 30), (40, 50)):
+        document = deep_document(depth, layers_per_group)
+        walk = best_time(lambda: walk_find_target_layer(document, "Target"))
+        build = best_time(lambda: LayerIndex(document).find_target_layer("Target"))
+        print(f"{depth:>6} {depth * (layers_per_group + 1):>7} {walk * 1e6:>13.1f} {build * 1e6:>9.1f}")
+
+
+if __name__ == "__main__":
+    lookups()
+    print()
+    first_lookup()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The repository root is a ComfyUI custom node package, so the protocol module is imported from its own package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
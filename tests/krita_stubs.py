@@ -0,0 +1,78 @@
+"""
+Stand-ins for the krita.Node and krita.Document calls the layer lookups make, for tests and benchmarks run without
+Krita. Children are kept bottom first, as childNodes() returns them, and index() is the position among them.
+"""
+import itertools
+
+_node_ids = itertools.count()
+
+
+class StubUuid:
+    def __init__(self, value):
+        self._value = value
+
+    def toString(self):
+        return f"{{00000000-0000-0000-0000-{self._value:012x}}}"
+
+
+class StubNode:
+    def __init__(self, name, node_type="paintlayer", children=()):
+        self._name = name
+        self._type = node_type
+        self._id = next(_node_ids)
+        self._parent = None
+        self._children = []
+        for child in children:
+            self.addChildNode(child, None)
+
+    def name(self):
+        return self._name
+
+    def setName(self, name):
+        self._name = name
+
+    def type(self):
+        return self._type
+
+    def uniqueId(self):
+        return StubUuid(self._id)
+
+    def parentNode(self):
+        return self._parent
+
+    def childNodes(self):
+        return list(self._children)
+
+    def index(self):
+        return self._parent._children.index(self)
+
+    def addChildNode(self, child, above):
+        # Krita adds on top when above is None
+        child._parent = self
+        self._children.append(child)
+
+    def remove(self):
+        self._parent._children.remove(self)
+        self._parent = None
+
+    def findChildNodes(self, name, recursive, partial_match, node_type, color_label):
+        return [child for child in self._children if child.name() == name and child.type() == node_type]
+
+
+class StubDocument:
+    def __init__(self, *children):
+        self._root = StubNode("root", "grouplayer", children)
+
+    def rootNode(self):
+        return self._root
+
+
+def group(name, *children):
+    """
+    Group layer, children listed bottom first.
+    """
+    return StubNode(name, "grouplayer", children)
+
+
+def paint(name):
+    return StubNode(name, "paintlayer")
@@ -0,0 +1,305 @@
+import importlib
+import json
+import random
+import struct
+import tracemalloc
+import types
+import zlib
+
+import pytest
+
+from krita_sync.cks_common.CksBinaryMessage import CksBinaryMessage, CksStreamDecoder, CksMessageAssembler, CksRawImage, \
+    SendImageKritaJsonPayload, GetImageKritaJsonPayload, PayloadType, PayloadCompression, CKS_MAGIC, PROTOCOL_VERSION
+
+
+def _message(payload_count=3, seed=0):
+    rng = random.Random(seed)
+    message = CksBinaryMessage(SendImageKritaJsonPayload("document", "layer", f"run-{seed}", False))
+    for i in range(payload_count):
+        if i % 3 == 0:
+            message.add_payload(PayloadType.PNG, rng.randbytes(rng.randint(0, 300)))
+        elif i % 3 == 1:
+            width, height = rng.randint(1, 9), rng.randint(1, 9)
+            message.add_payload(PayloadType.RAW_ARGB32, CksRawImage(width, height, width * 4, rng.randbytes(width * height * 4), x=i, y=-i))
+        else:
+            width, height = rng.randint(1, 9), rng.randint(1, 9)
+            data = bytes(rng.choice((0, 255)) for _ in range(width * height * 8))
+            message.add_payload(PayloadType.RAW_BGRA16, CksRawImage(width, height, width * 8, data, compression=PayloadCompression.ZLIB))
+    return message
+
+
+def _summary(message: CksBinaryMessage):
+    """
+    Comparable form of a message, payload views and raw images reduced to their bytes.
+    """
+    payloads = []
+    for (payload_type, content) in message.payloads:
+        if isinstance(content, CksRawImage):
+            payloads.append((payload_type, content.width, content.height, content.stride, content.x, content.y, bytes(content.data)))
+        else:
+            payloads.append((payload_type, bytes(content)))
+    return message.json_payload.serialize(), payloads
+
+
+def _random_splits(data: bytes, rng: random.Random):
+    idx = 0
+    while idx < len(data):
+        count = rng.choice((1, 2, 3, 7, 13, 64, 1000, len(data)))
+        yield data[idx:idx + count]
+        idx += count
+
+
+def _frame(*payloads, payload_count=None, version=PROTOCOL_VERSION, flags=0, magic=CKS_MAGIC):
+    """
+    Hand built frame of (payload type, content bytes) pairs, for headers encode_message would never write.
+    """
+    parts = [struct.pack(">3sBBI", magic, version, flags, len(payloads) if payload_count is None else payload_count)]
+    for (payload_type, content) in payloads:
+        parts.append(struct.pack(">BQ", payload_type, len(content)))
+        parts.append(content)
+    return b''.join(parts)
+
+
+def _json(payload=None):
+    return PayloadType.JSON, json.dumps(payload if payload is not None else SendImageKritaJsonPayload("d", "l", "r", False).__dict__).encode()
+
+
+@pytest.mark.parametrize("protocol_version", [1, 2])
+def test_encode_decode_roundtrip(protocol_version):
+    message = CksBinaryMessage(GetImageKritaJsonPayload("document", "layer", "prefix", "request"))
+    message.add_payload(PayloadType.PNG, b"\x89PNG not really")
+    decoded = CksBinaryMessage.decode_message(message.encode_message(protocol_version))
+    assert _summary(decoded) == _summary(message)
+
+
+def test_raw_payloads_roundtrip():
+    message = _message(payload_count=12)
+    assert _summary(CksBinaryMessage.decode_message(message.encode_message())) == _summary(message)
+
+
+def test_version_1_rejects_raw_payloads():
+    with pytest.raises(ValueError):
+        _message(payload_count=2).encode_message(1)
+
+
+def test_whole_payloads_are_views_of_the_fed_data():
+    message = CksBinaryMessage(SendImageKritaJsonPayload("d", "l", "r", False))
+    message.add_payload(PayloadType.PNG, b"x" * 1000)
+    data = message.encode_message()
+    (decoded,) = CksStreamDecoder().feed(data)
+    content = decoded.payloads[0][1]
+    assert isinstance(content, memoryview)
+    assert content.obj is data
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_random_feed_splits(seed):
+    rng = random.Random(seed)
+    messages = [_message(rng.randint(0, 7), seed * 100 + i) for i in range(rng.randint(1, 4))]
+    stream = b''.join(message.encode_message() for message in messages)
+
+    decoder = CksStreamDecoder()
+    decoded = []
+    for piece in _random_splits(stream, rng):
+        decoded.extend(decoder.feed(piece))
+    assert not decoder.in_progress
+    assert [_summary(message) for message in decoded] == [_summary(message) for message in messages]
+
+
+def test_byte_at_a_time():
+    message = _message(payload_count=6)
+    data = message.encode_message()
+    decoder = CksStreamDecoder()
+    decoded = []
+    for i in range(len(data)):
+        decoded.extend(decoder.feed(data[i:i + 1]))
+        # Nothing completes before the last byte
+        assert len(decoded) == (1 if i == len(data) - 1 else 0)
+    assert _summary(decoded[0]) == _summary(message)
+
+
+def test_payload_callback_runs_before_the_message_completes():
+    message = _message(payload_count=4)
+    data = message.encode_message()
+    seen = []
+    decoder = CksStreamDecoder(lambda decoded, payload_type, content: seen.append(payload_type))
+    # Everything but the last byte completes all but the last payload
+    assert decoder.feed(data[:-1]) == []
+    assert seen == [payload_type for (payload_type, _) in message.payloads[:-1]]
+    assert len(decoder.feed(data[-1:])) == 1
+    assert seen == [payload_type for (payload_type, _) in message.payloads]
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_interleaved_message_ids(seed):
+    rng = random.Random(seed)
+    messages = {message_id: _message(rng.randint(0, 6), seed * 100 + message_id) for message_id in range(rng.randint(2, 6))}
+    pending = {message_id: list(message.encode_chunks(message_id, rng.randint(1, 200))) for (message_id, message) in messages.items()}
+
+    assembler = CksMessageAssembler()
+    decoded = {}
+    while len(pending) > 0:
+        # Any message may send next, each one's chunks stay in order
+        message_id = rng.choice(list(pending))
+        chunk = pending[message_id].pop(0)
+        if len(pending[message_id]) == 0:
+            del pending[message_id]
+        for message in assembler.feed(chunk):
+            decoded[message.json_payload.run_uuid] = message
+    assert assembler.in_flight == 0
+    assert {run_uuid: _summary(message) for (run_uuid, message) in decoded.items()} == {message.json_payload.run_uuid: _summary(message) for message in messages.values()}
+
+
+def test_chunks_are_built_as_they_are_taken():
+    message = CksBinaryMessage(SendImageKritaJsonPayload("d", "l", "r", False))
+    message.add_payload(PayloadType.PNG, bytes(32 << 20))
+    chunks = message.encode_chunks(0, 1 << 20)
+    tracemalloc.start()
+    try:
+        next(chunks)
+        next(chunks)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # A few chunks, not the 32 MB the whole message takes
+    assert peak < 4 << 20
+
+
+def test_assembler_accepts_both_versions_and_whole_frames():
+    message = _message(payload_count=0)
+    assembler = CksMessageAssembler()
+    for data in (message.encode_message(1), message.encode_message(2)):
+        (decoded,) = assembler.feed(data)
+        assert _summary(decoded) == _summary(message)
+
+
+def test_out_of_order_chunk_drops_the_message():
+    message = _message(payload_count=5)
+    chunks = list(message.encode_chunks(7, 32))
+    assert len(chunks) > 2
+    assembler = CksMessageAssembler()
+    assembler.feed(chunks[0])
+    with pytest.raises(ValueError):
+        assembler.feed(chunks[2])
+    assert assembler.in_flight == 0
+
+
+def test_chunk_stream_must_start_at_zero():
+    chunks = list(_message(payload_count=5).encode_chunks(1, 32))
+    with pytest.raises(ValueError):
+        CksMessageAssembler().feed(chunks[1])
+
+
+def test_truncated_chunks_stay_in_flight():
+    chunks = list(_message(payload_count=5).encode_chunks(3, 32))
+    assembler = CksMessageAssembler()
+    for chunk in chunks[:-1]:
+        assert assembler.feed(chunk) == []
+    assert assembler.in_flight == 1
+    assert len(assembler.feed(chunks[-1])) == 1
+    assert assembler.in_flight == 0
+
+
+def test_oversized_payload_is_refused_before_it_arrives():
+    json_type, json_content = _json()
+    header = _frame((json_type, json_content), payload_count=2) + struct.pack(">BQ", PayloadType.PNG, 1 << 40)
+    with pytest.raises(ValueError):
+        CksStreamDecoder().feed(header)
+    with pytest.raises(ValueError):
+        CksStreamDecoder(max_payload_size=99).feed(_frame(_json(), (PayloadType.PNG, bytes(100))))
+
+
+def test_oldest_message_dropped_past_the_in_flight_limit():
+    chunks = {message_id: list(_message(payload_count=5, seed=message_id).encode_chunks(message_id, 32)) for message_id in range(3)}
+    assembler = CksMessageAssembler(max_in_flight=2)
+    for message_id in range(3):
+        assembler.feed(chunks[message_id][0])
+    assert assembler.in_flight == 2
+    # Message 0 was dropped, the rest of it no longer has a start
+    with pytest.raises(ValueError):
+        assembler.feed(chunks[0][1])
+    for chunk in chunks[2][1:]:
+        assembler.feed(chunk)
+    assert assembler.in_flight == 1
+
+
+def test_stale_message_dropped(monkeypatch):
+    now = [0.0]
+    module = importlib.import_module("krita_sync.cks_common.CksBinaryMessage")
+    monkeypatch.setattr(module, "time", types.SimpleNamespace(monotonic=lambda: now[0]))
+    stale_chunks = list(_message(payload_count=5, seed=1).encode_chunks(1, 32))
+    chunks = list(_message(payload_count=5, seed=2).encode_chunks(2, 32))
+    assembler = CksMessageAssembler(stale_after=10.0)
+    assembler.feed(stale_chunks[0])
+    now[0] = 5.0
+    assembler.feed(chunks[0])
+    now[0] = 11.0
+    assembler.feed(chunks[1])
+    assert assembler.in_flight == 2
+
+    # Starting another message drops the one without a chunk for 10 seconds
+    assembler.feed(list(_message(payload_count=5, seed=3).encode_chunks(3, 32))[0])
+    assert assembler.in_flight == 2
+    with pytest.raises(ValueError):
+        assembler.feed(stale_chunks[1])
+
+
+@pytest.mark.parametrize("cut", [1, 5, 9, 20, -1])
+def test_truncated_frame(cut):
+    data = _message(payload_count=3).encode_message()
+    decoder = CksStreamDecoder()
+    assert decoder.feed(data[:cut]) == []
+    assert decoder.in_progress
+    with pytest.raises(ValueError):
+        CksBinaryMessage.decode_message(data[:cut] if cut > len(CKS_MAGIC) else CKS_MAGIC + data[len(CKS_MAGIC):cut])
+
+
+@pytest.mark.parametrize("data", [
+    _frame(_json(), magic=b"CKX"),
+    _frame(_json(), version=1),
+    _frame(_json(), flags=1),
+    _frame(payload_count=0),
+    _frame((99, b"")),
+    _frame((PayloadType.PNG, b"png"), _json()),
+    _frame(_json(), _json()),
+    _frame((PayloadType.JSON, b"{not json")),
+    _frame(_json({"type": 99})),
+    _frame(_json({"no_type": 0})),
+    _frame(_json(), (PayloadType.RAW_ARGB32, b"short")),
+    _frame(_json(), (PayloadType.RAW_ARGB32, struct.pack(">IIIiiB", 4, 4, 16, 0, 0, 0) + b"too little")),
+    _frame(_json(), (PayloadType.RAW_ARGB32, struct.pack(">IIIiiB", 1, 1, 4, 0, 0, 7) + b"rgba")),
+], ids=["magic", "version", "flags", "no_payloads", "payload_type", "image_before_json", "two_json", "bad_json",
+        "message_type", "missing_type", "raw_header", "raw_data", "compression"])
+def test_malformed_frames(data):
+    with pytest.raises(ValueError):
+        CksStreamDecoder().feed(data)
+
+
+@pytest.mark.parametrize("data", [
+    b"JSON",
+    b"JSON:" + b"9" * 40,
+    b"NOT_A_TYPE:2,{}",
+    b"JSON:2,{}",
+    b"PNG:4,AAAA",
+])
+def test_malformed_version_1_messages(data):
+    with pytest.raises((ValueError, KeyError)):
+        CksBinaryMessage.decode_message(data)
+
+
+def test_zlib_tiles_arrive_uncompressed():
+    data = bytes(range(64)) * 4
+    message = CksBinaryMessage(SendImageKritaJsonPayload("d", "l", "r", False))
+    message.add_payload(PayloadType.RAW_ARGB32, CksRawImage(8, 8, 32, data, 3, 4, PayloadCompression.ZLIB))
+    encoded = message.encode_message()
+    assert zlib.compress(data, 1) in encoded
+    (payload_type, content) = CksBinaryMessage.decode_message(encoded).payloads[0]
+    assert (content.x, content.y, bytes(content.data)) == (3, 4, data)
+
+
+def test_many_payloads_decode_in_order():
+    message = CksBinaryMessage(SendImageKritaJsonPayload("d", "l", "r", False))
+    for i in range(4000):
+        message.add_payload(PayloadType.PNG, i.to_bytes(4, "big") * 16)
+    decoded = CksStreamDecoder().feed(message.encode_message())[0]
+    assert [bytes(content) for (payload_type, content) in decoded.payloads] == [i.to_bytes(4, "big") * 16 for i in range(4000)]
@@ -0,0 +1,125 @@
+import random
+
+from krita_sync.layer_index import LayerIndex
+from krita_stubs import StubDocument, group, paint
+
+
+def _walk(node):
+    """
+    Preorder, topmost first: the full-tree walk the index replaced.
+    """
+    result = [node]
+    for child in sorted(node.childNodes(), key=lambda child: child.index(), reverse=True):
+        result.extend(_walk(child))
+    return result
+
+
+def _walk_lookup(document, name):
+    return next((node for node in _walk(document.rootNode()) if node.name() == name and node.type() in ("grouplayer", "paintlayer")), None)
+
+
+def test_bare_name_is_first_match_in_preorder():
+    # Bottom first: the lone "Sketch" is below the group holding the other one
+    nested_sketch = paint("Sketch")
+    document = StubDocument(paint("Sketch"), group("Group", paint("Color"), nested_sketch))
+    assert LayerIndex(document).find_target_layer("Sketch") is nested_sketch
+
+
+def test_bare_name_prefers_a_group_over_its_children():
+    outer = group("Line", paint("Line"))
+    document = StubDocument(outer)
+    assert LayerIndex(document).find_target_layer("Line") is outer
+
+
+def test_path_lookup():
+    ink = paint("Ink")
+    inner = group("Inner", ink)
+    document = StubDocument(paint("Ink"), group("Outer", inner))
+    layer_index = LayerIndex(document)
+    assert layer_index.find_target_layer("Outer/Inner/Ink") is ink
+    assert layer_index.find_target_layer("Outer/Inner") is inner
+
+
+def test_path_with_a_missing_group_is_none():
+    document = StubDocument(group("Outer", group("Inner", paint("Ink"))))
+    layer_index = LayerIndex(document)
+    assert layer_index.find_target_layer("Outer/Missing/Ink") is None
+    assert layer_index.find_target_layer("Missing/Inner/Ink") is None
+
+
+def test_path_with_only_the_last_part_missing_is_its_group():
+    inner = group("Inner", paint("Ink"))
+    document = StubDocument(group("Outer", inner))
+    assert LayerIndex(document).find_target_layer("Outer/Inner/Missing") is inner
+
+
+def test_rebuilt_after_a_rename():
+    first, second = paint("Base"), paint("Base")
+    document = StubDocument(second, first)
+    layer_index = LayerIndex(document)
+    assert layer_index.find_target_layer("Base") is first
+
+    first.setName("Renamed")
+    assert layer_index.find_target_layer("Base") is second
+    assert layer_index.find_target_layer("Renamed") is first
+
+
+def test_rebuilt_after_a_removal():
+    ink = paint("Ink")
+    inner = group("Inner", ink)
+    outer = group("Outer", inner)
+    document = StubDocument(outer)
+    layer_index = LayerIndex(document)
+    assert layer_index.find_target_layer("Ink") is ink
+    assert layer_index.find_target_layer("Outer/Inner/Ink") is ink
+
+    ink.remove()
+    assert layer_index.find_target_layer("Ink") is None
+    assert layer_index.find_target_layer("Outer/Inner/Ink") is inner
+    outer.remove()
+    assert layer_index.find_target_layer("Outer/Inner/Ink") is None
+
+
+def test_added_layer_found_after_invalidate():
+    document = StubDocument(paint("Base"))
+    layer_index = LayerIndex(document)
+    assert layer_index.find_target_layer("Top") is None
+    top = paint("Top")
+    document.rootNode().addChildNode(top, None)
+    # A miss rebuilds, so a new name is found without invalidating
+    assert layer_index.find_target_layer("Top") is top
+
+    shadowing = paint("Top")
+    document.rootNode().addChildNode(shadowing, None)
+    layer_index.invalidate()
+    assert layer_index.find_target_layer("Top") is shadowing
+
+
+def test_find_group():
+    inner = group("Inner")
+    outer = group("Outer", inner)
+    document = StubDocument(paint("Inner"), outer)
+    layer_index = LayerIndex(document)
+    assert layer_index.find_group(document.rootNode(), "Outer") is outer
+    assert layer_index.find_group(outer, "Inner") is inner
+    assert layer_index.find_group(document.rootNode(), "Inner") is None
+
+
+def _random_tree(rng, depth):
+    children = []
+    for _ in range(rng.randint(0, 4)):
+        name = rng.choice("ABCD")
+        if depth > 0 and rng.random() < 0.5:
+            children.append(group(name, *_random_tree(rng, depth - 1)))
+        else:
+            children.append(paint(name))
+    return children
+
+
+def test_bare_names_match_the_full_walk():
+    rng = random.Random(0)
+    for _ in range(50):
+        document = StubDocument(*_random_tree(rng, 4))
+        layer_index = LayerIndex(document)
+        for name in "ABCDE":
+            assert layer_index.find_target_layer(name) is _walk_lookup(document, name)